@@ -1,4 +1,9 @@
 from __future__ import division
+import os
+import tempfile
+import threading
+import multiprocessing
+from collections import OrderedDict
 
 try:
     from StringIO import StringIO
@@ -7,7 +12,7 @@ except:  # PY3
     from io import StringIO
     import pickle as cPickle
 import numpy as np
-import scipy as sp
+from scipy import signal, fftpack, stats
 import pandas as pd
 from scipy.stats import gamma
 from sklearn.decomposition import PCA
@@ -30,19 +35,51 @@ class HRFModel(object):
         """Convolve the kernel with some data."""
         raise NotImplementedError
 
+    def convolve_matrix(self, data, frametimes, names):
+        """Convolve each column of a 2d array with the kernel.
+
+        Models that can convolve a batch of columns at once should override
+        this; the default just calls ``convolve`` on each column. The output
+        has all of the primary columns first, in the order of ``names``,
+        followed by any additional basis columns.
+
+        """
+        return _convolve_columns(self, data, frametimes, names)
+
+
+def _convolve_columns(hrf_model, data, frametimes, names):
+    """Convolve each column of a 2d array with ``hrf_model.convolve``."""
+    pieces = [hrf_model.convolve(col, frametimes, name)
+              for col, name in zip(np.transpose(data), names)]
+    out = pd.concat(pieces, axis=1)
+    extra = [c for c in out.columns if c not in names]
+    return out[list(names) + extra]
+
 
 class IdentityHRF(object):
     """HRF that does not transform the data. Mostly useful for testing."""
     def convolve(self, data, frametimes, name):
         return pd.DataFrame({name: data}, index=frametimes)
 
+    def convolve_matrix(self, data, frametimes, names):
+        return pd.DataFrame(data, index=frametimes, columns=names)
+
 
 class GammaDifferenceHRF(HRFModel):
     """Canonical difference of gamma variates HRF model."""
     def __init__(self, temporal_deriv=False, tr=2, oversampling=16,
                  kernel_secs=32, pos_shape=6, pos_scale=1,
-                 neg_shape=16, neg_scale=1, ratio=1./6):
-        """Create the HRF object with FSL parameters as default."""
+                 neg_shape=16, neg_scale=1, ratio=1./6, convolution="auto"):
+        """Create the HRF object with FSL parameters as default.
+
+        The ``convolution`` method can be "direct", "fft", or "auto", which
+        uses the FFT when the kernel is long enough for it to be faster.
+
+        """
+        if convolution not in ["direct", "fft", "auto"]:
+            raise ValueError("'convolution' must be 'direct', 'fft', "
+                             "or 'auto'")
+        self._convolution = convolution
         self._rv_pos = gamma(pos_shape, scale=pos_scale)
         self._rv_neg = gamma(neg_shape, scale=neg_scale)
         self._tr = tr
@@ -51,10 +88,17 @@ class GammaDifferenceHRF(HRFModel):
         self._timepoints = np.linspace(0, kernel_secs, kernel_secs / dt)
         self._temporal_deriv = temporal_deriv
         self._ratio = ratio
+        self._kernel = None
 
     @property
     def kernel(self):
         """Evaluate the kernel at timepoints, maybe with derivative."""
+        if self._kernel is None:
+            self._kernel = self._evaluate_kernel()
+        return self._kernel.copy()
+
+    def _evaluate_kernel(self):
+        """Compute the kernel (and derivative) from the gamma variates."""
         y = self._rv_pos.pdf(self._timepoints)
         y -= self._ratio * self._rv_neg.pdf(self._timepoints)
         y /= y.sum()
@@ -93,9 +137,7 @@ class GammaDifferenceHRF(HRFModel):
 
         # Without frametimes, assume data and kernel have same sampling
         if frametimes is None:
-            orig_ntp = ntp / self._oversampling
-            frametimes = np.arange(0, orig_ntp * self._tr,
-                                   self._tr / self._oversampling)
+            frametimes = self._default_frametimes(ntp)
 
         # Get the output name for this condition
         if name is None:
@@ -105,23 +147,89 @@ class GammaDifferenceHRF(HRFModel):
                 name = "event"
         cols = [name]
 
-        # Obtain the current kernel and set up the output
-        kernel = self.kernel.T
-        out = np.empty((ntp, len(kernel)))
-
-        # Do the convolution
         if self._temporal_deriv:
             cols.append(name + "_deriv")
-            main, deriv = kernel
-            out[:, 0] = np.convolve(data, main)[:ntp]
-            out[:, 1] = np.convolve(data, deriv)[:ntp]
-        else:
-            out[:, 0] = np.convolve(data, kernel.ravel())[:ntp]
+
+        # Do the convolution
+        out = self._convolve_array(np.asarray(data).reshape(ntp, 1))
 
         # Build the output DataFrame
         out = pd.DataFrame(out, columns=cols, index=frametimes)
         return out
 
+    def convolve_matrix(self, data, frametimes=None, names=None):
+        """Convolve the kernel with each column of a 2d array at once.
+
+        Parameters
+        ----------
+        data : DataFrame or 2d array
+            data to convolve, with timepoints in the rows
+        frametimes : Series or 1d array, optional
+            timepoints corresponding to data - if None, assume
+            data is sampled with same TR and oversampling as kernal
+        names : list of strings, optional
+            names to associate with the columns if not passing a DataFrame
+
+        Returns
+        -------
+        out : DataFrame
+            convolved columns, followed by the convolved derivative
+            columns if the kernel has a temporal derivative
+
+        """
+        ntp = len(data)
+        if frametimes is None:
+            frametimes = self._default_frametimes(ntp)
+
+        if names is None:
+            try:
+                names = data.columns.tolist()
+            except AttributeError:
+                n_cols = np.shape(data)[1]
+                names = ["event_%d" % i for i in range(n_cols)]
+        cols = list(names)
+        if self._temporal_deriv:
+            cols += [name + "_deriv" for name in names]
+
+        out = self._convolve_array(np.asarray(data))
+        out = pd.DataFrame(out, columns=cols, index=frametimes)
+        return out
+
+    def _convolve_array(self, data):
+        """Convolve the columns of a 2d array with each kernel basis.
+
+        Returns a 2d array with the output for the main kernel in the first
+        block of columns, followed by the derivative block, if present.
+
+        """
+        kernel = self.kernel
+        ntp, n_k = len(data), len(kernel)
+        data = np.asarray(data, np.float)
+
+        method = self._convolution
+        if method == "auto":
+            # Empirical crossover for where the FFT overhead pays off
+            method = "fft" if n_k >= 128 else "direct"
+
+        if method == "direct":
+            out = [signal.lfilter(k, 1, data, axis=0) for k in kernel.T]
+        else:
+            # Transform the data once and reuse it for each basis function
+            n_fft = fftpack.next_fast_len(ntp + n_k - 1)
+            data_fft = np.fft.rfft(data, n_fft, axis=0)
+            kernel_fft = np.fft.rfft(kernel, n_fft, axis=0)
+            out = [np.fft.irfft(data_fft * k_fft[:, None], n_fft, axis=0)
+                   for k_fft in kernel_fft.T]
+            out = [o[:ntp] for o in out]
+
+        return np.hstack(out)
+
+    def _default_frametimes(self, ntp):
+        """Frametimes for data sampled at the resolution of the kernel."""
+        orig_ntp = ntp / self._oversampling
+        return np.arange(0, orig_ntp * self._tr,
+                         self._tr / self._oversampling)
+
 
 class FIR(HRFModel):
     """Finite Impule Response HRF model."""
@@ -180,6 +288,8 @@ class DesignMatrix(object):
             condition column.
         hrf_model : HRFModel class
             this class must specify its own "convolution" semantics
+            through a ``convolve`` method, and can convolve all conditions
+            at once through a ``convolve_matrix`` method
         ntp : int
             number of timepoints in the data
         regressors : array or DataFrame
@@ -233,15 +343,18 @@ class DesignMatrix(object):
         self._ntp = ntp
 
         # Convolve the oversampled condition evs
-        self._make_hires_base(oversampling)
+        self._make_hires_base()
         self._convolve(hrf_model)
 
         # Subsample the condition evs and highpass filter
         conditions = self._subsample_condition_matrix()
-        conditions -= conditions.mean()
-        pp_heights = (conditions.max() - conditions.min()).tolist()
+        conditions -= conditions.mean(axis=0)
+        pp_heights = (conditions.max(axis=0) -
+                      conditions.min(axis=0)).tolist()
         if hpf_cutoff is not None:
             conditions = self._highpass_filter(conditions, hpf_cutoff)
+        conditions = pd.DataFrame(conditions, index=self.frametimes,
+                                  columns=self._hires_conditions.columns)
 
         # Set up the other regressors of interest
         regressors = self._validate_component(regressors, "regressor")
@@ -321,64 +434,53 @@ class DesignMatrix(object):
         """Represent the object with the design matrix."""
         return self.design_matrix._repr_html_()
 
-    def _make_hires_base(self, oversampling):
+    def _make_hires_base(self):
         """Make the oversampled condition base submatrix."""
-        hires_base = pd.DataFrame(columns=self._condition_names,
-                                  index=self._hires_frametimes)
-
-        for cond in self._condition_names:
-            cond_info = self.design[self.design.condition == cond]
-            cond_info = cond_info[["onset", "duration", "value"]]
-            ev = self._make_hires_ev_base(cond_info)
-            hires_base[cond] = ev
-        self._hires_base = hires_base
-
-    def _make_hires_ev_base(self, info):
-        """Oversample a condition ev vector."""
         hft = self._hires_frametimes
+        tmax = len(hft)
 
-        # Get the condition information
-        onsets, durations, vals = info.values.T
+        # Find the ev column for each event, dropping unused conditions
+        names = pd.Index(self._condition_names)
+        col = names.get_indexer(self.design.condition)
+        info = self.design.loc[col > -1, ["onset", "duration", "value"]]
+        onsets, durations, vals = info.values.astype(np.float).T
+        col = col[col > -1]
 
-        # Make the ev timecourse
-        tmax = len(hft)
-        ev = np.zeros_like(hft).astype(np.float)
+        # Mark onsets and offsets of every event on the hires timeline
         t_onset = np.minimum(np.searchsorted(hft, onsets), tmax - 1)
-        ev[t_onset] += vals
         t_offset = np.minimum(np.searchsorted(hft, onsets + durations),
-                              len(hft) - 1)
+                              tmax - 1)
 
         # Handle the case where duration is 0 by offsetting at t + 1
-        for i, off in enumerate(t_offset):
-            if off < (tmax - 1) and off == t_onset[i]:
-                t_offset[i] += 1
+        t_offset[(t_offset < (tmax - 1)) & (t_offset == t_onset)] += 1
 
-        ev[t_offset] -= vals
-        ev = np.cumsum(ev)
+        hires_base = np.zeros((tmax, len(self._condition_names)))
+        hires_base[t_onset, col] += vals
+        hires_base[t_offset, col] -= vals
+        hires_base = np.cumsum(hires_base, axis=0)
 
-        return ev
+        self._hires_base = pd.DataFrame(hires_base, index=hft,
+                                        columns=self._condition_names)
 
     def _convolve(self, hrf_model):
         """Convolve the condition evs with the HRF model."""
-        self._hires_conditions = self._hires_base.copy()
-        for cond in self._condition_names:
-            res = hrf_model.convolve(self._hires_base[cond],
-                                     self._hires_frametimes,
-                                     cond)
-            for key, vals in res.iteritems():
-                self._hires_conditions[key] = vals
+        # Models that only define ``convolve`` get the column-wise default
+        args = (self._hires_base.values, self._hires_frametimes,
+                self._condition_names.tolist())
+        convolve_matrix = getattr(hrf_model, "convolve_matrix", None)
+        if convolve_matrix is None:
+            self._hires_conditions = _convolve_columns(hrf_model, *args)
+        else:
+            self._hires_conditions = convolve_matrix(*args)
 
     def _subsample_condition_matrix(self):
         """Sample the hires convolved matrix at the TR midpoint."""
-        condition_X = pd.DataFrame(columns=self._hires_conditions.columns,
-                                   index=self.frametimes)
-
-        frametime_midpoints = self.frametimes + self.tr / 2
-        for key, vals in self._hires_conditions.iteritems():
-            resampler = sp.interpolate.interp1d(self._hires_frametimes, vals,
-                                                kind="nearest")
-            condition_X[key] = resampler(frametime_midpoints)
-        return condition_X
+        # Nearest neighbor sampling, with ties going to the earlier sample
+        hft = self._hires_frametimes
+        frametime_midpoints = self.frametimes.values + self.tr / 2
+        bin_edges = (hft[1:] + hft[:-1]) / 2
+        idx = np.searchsorted(bin_edges, frametime_midpoints, side="left")
+        return self._hires_conditions.values[idx]
 
     def _validate_component(self, comp, name_base):
         """For components that can be an an array or df, build the df."""
@@ -408,10 +510,8 @@ class DesignMatrix(object):
 
     def _highpass_filter(self, mat, cutoff):
         """Highpass-filter each column in mat."""
-        F = fsl_highpass_matrix(self._ntp, cutoff, self.tr)
-        for key, vals in mat.iteritems():
-            mat[key] = np.dot(F, vals)
-        return mat
+        F = filter_cache.get(self._ntp, cutoff, self.tr)
+        return np.dot(F, mat)
 
     def contrast_vector(self, names, weights):
         """Return a full contrast vector given condition names and weights."""
@@ -565,6 +665,59 @@ class DesignMatrix(object):
         with open(fname, "r") as fid:
             return cPickle.load(fid)
 
+    @classmethod
+    def from_many(cls, designs, hrf_model, ntp, n_jobs=1, **kwargs):
+        """Build a design matrix for each of many designs.
+
+        The HRF kernel and the highpass filter matrices are computed once
+        and shared across all designs that use them (once per process when
+        building in parallel).
+
+        Parameters
+        ----------
+        designs : list of DataFrames
+            design specification for each matrix, as in the constructor
+        hrf_model : HRFModel class
+            HRF model used to build every matrix
+        ntp : int or list of ints
+            number of timepoints, either for all designs or for each one
+        n_jobs : int
+            number of processes to build the matrices in. 1 builds them
+            serially in this process, -1 uses all available cores
+        kwargs : key, value mappings
+            other keyword arguments are passed to every constructor call
+
+        Returns
+        -------
+        matrices : list of DesignMatrix objects
+            matrices in the same order as ``designs``
+
+        """
+        if np.isscalar(ntp):
+            ntp = [ntp] * len(designs)
+        if len(ntp) != len(designs):
+            raise ValueError("Length of ntp does not match designs.")
+        tasks = list(zip(designs, ntp))
+
+        if n_jobs == -1:
+            n_jobs = multiprocessing.cpu_count()
+        n_jobs = min(n_jobs, len(tasks))
+        if n_jobs <= 1:
+            return _build_design_matrices((hrf_model, tasks, kwargs))
+
+        # Give each worker one contiguous batch, so the shared setup only
+        # happens once per process and the HRF model is only sent once
+        splits = np.array_split(np.arange(len(tasks)), n_jobs)
+        batches = [(hrf_model, [tasks[i] for i in split], kwargs)
+                   for split in splits]
+        pool = multiprocessing.Pool(n_jobs)
+        try:
+            results = pool.map(_build_design_matrices, batches)
+        finally:
+            pool.close()
+            pool.join()
+        return [X for batch in results for X in batch]
+
     @property
     def main_submatrix(self):
         """Conditions (no derivatives) and regressors."""
@@ -595,11 +748,212 @@ class DesignMatrix(object):
         return self.design_matrix.shape
 
 
+def _build_design_matrices(args):
+    """Build a batch of design matrices; module-level so it can be pickled."""
+    hrf_model, tasks, kwargs = args
+    return [DesignMatrix(design, hrf_model, ntp, **kwargs)
+            for design, ntp in tasks]
+
+
+class GLM(object):
+    """Mass-univariate linear model for timeseries data.
+
+    The design is decomposed once, and the data are fit in chunks of
+    columns (e.g. voxels) that share that decomposition, so the memory
+    needed for the fit is bounded by ``chunk_size`` rather than by the
+    size of the data. Memory-mapped data is only read one chunk at a time.
+
+    The design matrix columns (which are already centered for a
+    DesignMatrix) and the data are de-meaned, which is equivalent to
+    including a constant in the model.
+
+    With ``prewhiten=True``, serial autocorrelation is corrected with an
+    AR(1) model. The AR coefficient is estimated from the OLS residuals of
+    each column and rounded to ``ar_precision``, and then all columns that
+    share a coefficient are fit with one whitened design. The cost of the
+    fit thus scales with the number of distinct coefficients rather than
+    with the number of columns.
+
+    """
+    def __init__(self, X, chunk_size=10000, prewhiten=False,
+                 ar_precision=.01):
+        """Set up the model.
+
+        Parameters
+        ----------
+        X : DesignMatrix, DataFrame, or 2d array
+            design matrix with timepoints in the rows
+        chunk_size : int
+            number of data columns to fit at once
+        prewhiten : bool
+            if True, fit the model with AR(1) prewhitening
+        ar_precision : float
+            resolution of the bins for AR coefficients when prewhitening
+
+        """
+        if isinstance(X, DesignMatrix):
+            X = X.design_matrix
+        try:
+            self._ev_names = X.columns.tolist()
+        except AttributeError:
+            self._ev_names = None
+        X = np.asarray(X, np.float)
+        self.X = X - X.mean(axis=0)
+        self.chunk_size = chunk_size
+        self.prewhiten = prewhiten
+        self.ar_precision = ar_precision
+
+    def fit(self, data):
+        """Estimate the model parameters for each column of the data.
+
+        Parameters
+        ----------
+        data : 1d or 2d array
+            data array where first dimension is observations
+
+        Returns
+        -------
+        self : reference to self
+
+        """
+        X = self.X
+        ntp, n_ev = X.shape
+        if len(data) != ntp:
+            raise ValueError("Data length does not match design matrix.")
+        data = np.reshape(data, (ntp, -1))
+        n_cols = data.shape[1]
+
+        X_pinv = np.linalg.pinv(X)
+        dof = ntp - np.linalg.matrix_rank(X) - 1
+
+        # Each bin of columns shares a whitened design; OLS has just one
+        bin_keys = {}
+        solvers = [(X, X_pinv)]
+        XtX_inv = [np.dot(X_pinv, X_pinv.T)]
+        max_key = int(np.round(1 / self.ar_precision)) - 1
+
+        betas = np.empty((n_ev, n_cols))
+        sigma2 = np.empty(n_cols)
+        bins = np.zeros(n_cols, np.int)
+        ar1 = np.zeros(n_cols) if self.prewhiten else None
+        for start in range(0, n_cols, self.chunk_size):
+            cols = np.arange(start, min(start + self.chunk_size, n_cols))
+            Y = np.array(data[:, cols], np.float)
+            Y -= Y.mean(axis=0)
+            B = np.dot(X_pinv, Y)
+            resid = Y - np.dot(X, B)
+
+            if not self.prewhiten:
+                betas[:, cols] = B
+                sigma2[cols] = np.square(resid).sum(axis=0) / dof
+                continue
+
+            # Estimate and quantize the lag-one autocorrelations
+            with np.errstate(invalid="ignore", divide="ignore"):
+                rho = ((resid[1:] * resid[:-1]).sum(axis=0) /
+                       np.square(resid).sum(axis=0))
+            rho[~np.isfinite(rho)] = 0
+            keys = np.round(rho / self.ar_precision).astype(np.int)
+            keys = np.clip(keys, -max_key, max_key)
+
+            for key in np.unique(keys):
+                if key not in bin_keys:
+                    X_w = _ar1_whiten(X, key * self.ar_precision, True)
+                    X_w_pinv = np.linalg.pinv(X_w)
+                    bin_keys[key] = len(solvers)
+                    solvers.append((X_w, X_w_pinv))
+                    XtX_inv.append(np.dot(X_w_pinv, X_w_pinv.T)[:-1, :-1])
+                i = bin_keys[key]
+                X_w, X_w_pinv = solvers[i]
+
+                in_bin = keys == key
+                Y_w = _ar1_whiten(Y[:, in_bin], key * self.ar_precision)
+                B = np.dot(X_w_pinv, Y_w)
+                resid = Y_w - np.dot(X_w, B)
+
+                bin_cols = cols[in_bin]
+                betas[:, bin_cols] = B[:-1]
+                sigma2[bin_cols] = np.square(resid).sum(axis=0) / dof
+                bins[bin_cols] = i
+                ar1[bin_cols] = key * self.ar_precision
+
+        self.betas_ = betas
+        self.sigma2_ = sigma2
+        self.dof_ = dof
+        self.ar1_ = ar1
+        self._bins = bins
+        self._XtX_inv = np.array(XtX_inv)
+        return self
+
+    def contrast(self, contrasts):
+        """Compute t and z statistics for a list of contrasts.
+
+        Parameters
+        ----------
+        contrasts : list
+            each entry is either a contrast vector with a weight for each
+            column of the design or, if the design has column names, a
+            (name, ev_names, weights) tuple as in DesignMatrix.to_fsl_files
+
+        Returns
+        -------
+        t : n_contrasts x n_cols array
+            t statistics
+        z : n_contrasts x n_cols array
+            z statistics with the same upper tail probability as ``t``
+
+        """
+        C = np.array([self._contrast_vector(c) for c in contrasts])
+
+        # Contrast variance for each bin, then mapped out to each column
+        effect = np.dot(C, self.betas_)
+        variance = np.sum(np.dot(self._XtX_inv, C.T) * C.T, axis=1).T
+        variance = variance[:, self._bins] * self.sigma2_
+        t = effect / np.sqrt(variance)
+
+        # Convert through the tail probability of |t| for precision
+        p = stats.t.sf(np.abs(t), self.dof_)
+        z = np.sign(t) * stats.norm.isf(p)
+        return t, z
+
+    def _contrast_vector(self, contrast):
+        """Build a full contrast vector from a contrast specification."""
+        if len(contrast) == 3 and not np.isscalar(contrast[1]):
+            if self._ev_names is None:
+                raise ValueError("Named contrasts need design column names.")
+            _, names, weights = contrast
+            vector = np.zeros(len(self._ev_names))
+            for name, weight in zip(names, weights):
+                vector[self._ev_names.index(name)] = weight
+            return vector
+
+        vector = np.asarray(contrast, np.float)
+        if len(vector) != self.X.shape[1]:
+            raise ValueError("Contrast length does not match design matrix.")
+        return vector
+
+
+def _ar1_whiten(data, rho, add_constant=False):
+    """Prewhiten the columns of a 2d array with an AR(1) model."""
+    if add_constant:
+        data = np.column_stack((data, np.ones(len(data))))
+    white = np.empty_like(data)
+    white[0] = np.sqrt(1 - rho ** 2) * data[0]
+    white[1:] = data[1:] - rho * data[:-1]
+    return white
+
+
 def fsl_highpass_matrix(ntp, cutoff, tr=2):
     """Return an array to implement FSL's gaussian running line filter.
 
     To implement the filter, premultiply your data with this array.
 
+    Each row is the residual-forming vector for a line fit around that
+    timepoint, weighted by a gaussian kernel. Because the local design is
+    just an intercept and a slope, the fit is computed in closed form from
+    weighted sums over the kernel's effective support, rather than by
+    inverting a full weighted design for every row.
+
     Parameters
     ----------
     ntp : int
@@ -614,27 +968,197 @@ def fsl_highpass_matrix(ntp, cutoff, tr=2):
     F : ntp square array
         filter matrix
 
+    """
+    F = np.eye(ntp)
+    for rows, cols, H in _highpass_hat_blocks(ntp, cutoff, tr):
+        F[rows, cols] -= H
+    return F
+
+
+def _highpass_hat_blocks(ntp, cutoff, tr, max_elements=2 ** 17):
+    """Generate the running line hat matrix in blocks of rows.
+
+    Each row of the hat matrix is only nonzero within the kernel window
+    around its timepoint, so a block of rows is built only over the columns
+    that fall in the window of some row in the block. Block sizes are
+    chosen so that no block has more than ``max_elements`` entries, which
+    keeps memory well below that of the full ntp x ntp matrix.
+
+    Yields
+    ------
+    rows, cols : slices
+        rows of the hat matrix in the block, and the columns it covers
+    H : n_rows x n_cols array
+        hat matrix weights for the block
+
     """
     cutoff = cutoff / tr
     sig2n = np.square(cutoff / np.sqrt(2))
 
-    kernel = np.exp(-np.square(np.arange(ntp)) / (2 * sig2n))
-    kernel = 1 / np.sqrt(2 * np.pi * sig2n) * kernel
+    # The weighted least squares fit uses the square of the gaussian
+    # kernel, so truncate it where that falls below machine precision
+    eps = np.finfo(np.float).eps
+    half_width = int(np.ceil(np.sqrt(-np.log(eps) * sig2n)))
+    half_width = min(half_width, ntp - 1)
+
+    block_size = 1
+    while (block_size < ntp and 2 * block_size *
+           min(ntp, 2 * block_size + 2 * half_width) <= max_elements):
+        block_size *= 2
+
+    for start in range(0, ntp, block_size):
+        stop = min(start + block_size, ntp)
+        col_start = max(0, start - half_width)
+        col_stop = min(ntp, stop + half_width)
+
+        # Offsets of each column from each row's timepoint, and the
+        # truncated kernel weights at those offsets
+        offsets = (np.arange(col_start, col_stop)
+                   - np.arange(start, stop).reshape(-1, 1))
+        w = np.exp(-np.square(offsets) / sig2n)
+        w[np.abs(offsets) > half_width] = 0
+
+        # Weighted sums for a line centered on each timepoint
+        s0 = w.sum(axis=1)
+        s1 = (w * offsets).sum(axis=1)
+        s2 = (w * np.square(offsets)).sum(axis=1)
+        det = s0 * s2 - np.square(s1)
+
+        # Evaluating the fit at the center only needs the intercept,
+        # although with a single effective observation the slope is not
+        # identifiable
+        line = det > eps * s0 * s2
+        H = np.empty_like(w)
+        H[line] = (w[line] * (s2[line, None] - s1[line, None] *
+                              offsets[line]) / det[line, None])
+        H[~line] = w[~line] / s0[~line, None]
+
+        yield slice(start, stop), slice(col_start, col_stop), H
+
+
+def _apply_highpass_hat(data, cutoff, tr):
+    """Filter the columns of a 2d array without the full filter matrix."""
+    orig = np.array(data, np.float)
+    out = orig.copy()
+    for rows, cols, H in _highpass_hat_blocks(len(data), cutoff, tr):
+        out[rows] -= np.dot(H, orig[cols])
+    return out
+
+
+class FilterMatrixCache(object):
+    """Least-recently-used cache of highpass filter matrices.
+
+    Matrices are keyed by (ntp, cutoff, tr) and are returned read-only, as
+    the same array is shared by every caller that asks for those parameters.
+
+    Attributes
+    ----------
+    max_bytes : int
+        memory budget for matrices held in the cache. the least recently
+        used matrices are dropped when a new matrix would exceed it
+    cache_dir : string or None
+        if not None, matrices are also saved to ``.npy`` files in this
+        directory, which are memory-mapped (rather than rebuilt) on a miss
+        in the memory cache, including in other processes
 
-    K = sp.linalg.toeplitz(kernel)
-    K = np.dot(np.diag(1 / K.sum(axis=1)), K)
+    """
+    def __init__(self, max_bytes=256 * 2 ** 20, cache_dir=None):
+        """Create an empty cache."""
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self._matrices = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self.hits, self.disk_hits, self.misses = 0, 0, 0
+
+    def get(self, ntp, cutoff, tr=2):
+        """Return the (read-only) filter matrix for these parameters."""
+        key = int(ntp), float(cutoff), float(tr)
+        with self._lock:
+            if key in self._matrices:
+                self.hits += 1
+                F = self._matrices.pop(key)
+                self._matrices[key] = F
+                return F
+
+        F = self._load(key)
+        if F is None:
+            F = fsl_highpass_matrix(*key)
+            F.flags.writeable = False
+            self._save(key, F)
+            with self._lock:
+                self.misses += 1
+        else:
+            with self._lock:
+                self.disk_hits += 1
+
+        with self._lock:
+            self._store(key, F)
+        return F
+
+    def info(self):
+        """Return a dictionary of cache statistics."""
+        with self._lock:
+            return dict(hits=self.hits, disk_hits=self.disk_hits,
+                        misses=self.misses, size=len(self._matrices),
+                        nbytes=self._nbytes, max_bytes=self.max_bytes)
+
+    def clear(self):
+        """Drop all matrices from memory and reset the statistics."""
+        with self._lock:
+            self._matrices.clear()
+            self._nbytes = 0
+            self.hits, self.disk_hits, self.misses = 0, 0, 0
+
+    def _store(self, key, F):
+        """Add a matrix to the memory cache, evicting old ones as needed."""
+        if key in self._matrices or F.nbytes > self.max_bytes:
+            return
+        while self._matrices and self._nbytes + F.nbytes > self.max_bytes:
+            _, old = self._matrices.popitem(last=False)
+            self._nbytes -= old.nbytes
+        self._matrices[key] = F
+        self._nbytes += F.nbytes
+
+    def _fname(self, key):
+        """Return the on-disk path for a matrix."""
+        fname = "highpass_%d_%r_%r.npy" % key
+        return os.path.join(self.cache_dir, fname)
+
+    def _load(self, key):
+        """Memory-map a matrix from the cache directory, if it exists."""
+        if self.cache_dir is None:
+            return None
+        fname = self._fname(key)
+        if not os.path.exists(fname):
+            return None
+        return np.load(fname, mmap_mode="r")
 
-    H = np.zeros((ntp, ntp))
-    X = np.column_stack((np.ones(ntp), np.arange(ntp)))
-    for k in range(ntp):
-        W = np.diag(K[k])
-        hat = np.dot(np.dot(X, np.linalg.pinv(np.dot(W, X))), W)
-        H[k] = hat[k]
-    F = np.eye(ntp) - H
-    return F
+    def _save(self, key, F):
+        """Save a matrix to the cache directory, if there is one."""
+        if self.cache_dir is None:
+            return
+        try:
+            os.makedirs(self.cache_dir)
+        except OSError:
+            if not os.path.isdir(self.cache_dir):
+                raise
+
+        # Write to a uniquely named temporary file so other threads and
+        # processes never see a partial matrix, then move it into place
+        fname = self._fname(key)
+        fd, tmp_fname = tempfile.mkstemp(suffix=".tmp", dir=self.cache_dir,
+                                         prefix=os.path.basename(fname))
+        with os.fdopen(fd, "wb") as fid:
+            np.save(fid, F)
+        os.rename(tmp_fname, fname)
 
 
-def fsl_highpass_filter(data, cutoff=128, tr=2, copy=True):
+filter_cache = FilterMatrixCache()
+
+
+def fsl_highpass_filter(data, cutoff=128, tr=2, copy=True,
+                        matrix_free=False, chunk_size=10000):
     """Highpass filter data with gaussian running line filter.
 
     Parameters
@@ -647,12 +1171,24 @@ def fsl_highpass_filter(data, cutoff=128, tr=2, copy=True):
         data TR in seconds
     copy : boolean
         if False data is filtered in place
+    matrix_free : boolean
+        if True, apply the running line fit directly within the kernel
+        window instead of building the full filter matrix. combined with
+        ``copy=False``, this lets (memory-mapped) data larger than memory
+        be filtered in place
+    chunk_size : int
+        number of columns to filter at once when ``matrix_free`` is True
 
     Returns
     -------
     data : 1d or 2d array
         filtered version of the data
 
+    Notes
+    -----
+    Filter matrices are taken from the process-level ``filter_cache``,
+    so repeatedly filtering data with the same shape is cheap.
+
     """
     if copy:
         data = data.copy()
@@ -660,8 +1196,14 @@ def fsl_highpass_filter(data, cutoff=128, tr=2, copy=True):
     ntp = len(data)
     data = np.atleast_2d(data).reshape(ntp, -1)
 
-    # Filter each column of the data
-    F = fsl_highpass_matrix(ntp, cutoff, tr)
-    data[:] = np.dot(F, data)
+    if matrix_free:
+        # Filter bounded blocks of columns without an ntp x ntp array
+        for start in range(0, data.shape[1], chunk_size):
+            chunk = data[:, start:start + chunk_size]
+            chunk[:] = _apply_highpass_hat(chunk, cutoff, tr)
+    else:
+        # Filter each column of the data
+        F = filter_cache.get(ntp, cutoff, tr)
+        data[:] = np.dot(F, data)
 
     return data.squeeze()
@@ -1,96 +1,111 @@
 """Constrained multivariate least-squares optimization"""
 
 import warnings
+import multiprocessing
 
-from numpy import array, take, eye, triu, transpose, dot
-from numpy import empty_like, sqrt, cos, sin, arcsin
+from numpy import array, take, eye, triu, transpose, dot, zeros, ones_like
+from numpy import concatenate, hypot, sqrt, cos, sin, arcsin
+from numpy import nan, inf, isnan, isfinite, flatnonzero, argmin, where
+from numpy.random import RandomState
 from scipy.optimize.minpack import _check_func
 from scipy.optimize import _minpack, leastsq
 
 
+def _bound_sets(bounds):
+    """
+    Make arrays of the lower and upper bounds and split the parameters into
+    index sets of unbounded, lower bounded, upper bounded and two-sided
+    bounded parameters.
+    """
+    lower = array([nan if b[0] is None else b[0] for b in bounds], float)
+    upper = array([nan if b[1] is None else b[1] for b in bounds], float)
+    has_lower, has_upper = ~isnan(lower), ~isnan(upper)
+    sets = (flatnonzero(~has_lower & ~has_upper),
+            flatnonzero(has_lower & ~has_upper),
+            flatnonzero(~has_lower & has_upper),
+            flatnonzero(has_lower & has_upper))
+    return lower, upper, sets
+
+
 def _internal2external_grad(xi, bounds):
     """
     Calculate the internal (unconstrained) to external (constained)
     parameter gradiants.
     """
-    grad = empty_like(xi)
-    for i, (v, bound) in enumerate(zip(xi, bounds)):
-        lower, upper = bound
-        if lower is None and upper is None:  # No constraints
-            grad[i] = 1.0
-        elif upper is None:     # only lower bound
-            grad[i] = v / sqrt(v * v + 1.)
-        elif lower is None:     # only upper bound
-            grad[i] = -v / sqrt(v * v + 1.)
-        else:   # lower and upper bounds
-            grad[i] = (upper - lower) * cos(v) / 2.
-    return grad
+    return _internal2external_grad_func(bounds)(xi)
 
 
-def _internal2external_func(bounds):
+def _internal2external_coefs(bounds):
     """
-    Make a function which converts between internal (unconstrained) and
-    external (constrained) parameters.
+    Write the internal to external transform of every parameter as
+
+        p_e = a * p_i + b + c * sqrt(p_i**2 + 1) + d * sin(p_i)
+
+    and return the coefficient arrays, so that all parameters can be
+    transformed together whatever their kind of bound.
     """
-    ls = [_internal2external_lambda(b) for b in bounds]
+    lower, upper, (free, lo, up, both) = _bound_sets(bounds)
+    a, b, c, d = zeros((4, len(bounds)))
+    a[free] = 1.
+    b[lo], c[lo] = lower[lo] - 1., 1.
+    b[up], c[up] = upper[up] + 1., -1.
+    d[both] = (upper[both] - lower[both]) / 2.
+    b[both] = lower[both] + d[both]
+    return a, b, c, d
 
-    def convert_i2e(xi):
-        xe = empty_like(xi)
-        xe[:] = [l(p) for l, p in zip(ls, xi)]
-        return xe
 
-    return convert_i2e
+def _internal2external_grad_func(bounds):
+    """
+    Make a function which calculates the internal to external parameter
+    gradients for a parameter vector or an array with one per row.
+    """
+    a, _, c, d = _internal2external_coefs(bounds)
+
+    def grad_i2e(xi):
+        return a + c * xi / hypot(xi, 1.) + d * cos(xi)
 
+    return grad_i2e
 
-def _internal2external_lambda(bound):
+
+def _internal2external_func(bounds):
     """
-    Make a lambda function which converts a single internal (uncontrained)
-    parameter to a external (constrained) parameter.
+    Make a function which converts between internal (unconstrained) and
+    external (constrained) parameters, for a parameter vector or an array
+    with one per row.
     """
-    lower, upper = bound
-
-    if lower is None and upper is None:  # no constraints
-        return lambda x: x
-    elif upper is None:     # only lower bound
-        return lambda x: lower - 1. + sqrt(x * x + 1.)
-    elif lower is None:     # only upper bound
-        return lambda x: upper + 1. - sqrt(x * x + 1.)
-    else:
-        return lambda x: lower + ((upper - lower) / 2.) * (sin(x) + 1.)
+    a, b, c, d = _internal2external_coefs(bounds)
+
+    def convert_i2e(xi):
+        return a * xi + b + c * hypot(xi, 1.) + d * sin(xi)
+
+    return convert_i2e
 
 
 def _external2internal_func(bounds):
     """
     Make a function which converts between external (constrained) and
-    internal (unconstrained) parameters.
+    internal (unconstrained) parameters, for a parameter vector or an array
+    with one per row.
     """
-    ls = [_external2internal_lambda(b) for b in bounds]
+    lower, upper, (_, lo, up, both) = _bound_sets(bounds)
+    bound_range = upper[both] - lower[both]
+    one_sided = concatenate([lo, up])
+    offset = concatenate([1. - lower[lo], upper[up] + 1.])
+    sign = concatenate([ones_like(lo), -ones_like(up)])
 
     def convert_e2i(xe):
-        xi = empty_like(xe)
-        xi[:] = [l(p) for l, p in zip(ls, xe)]
+        xi = array(xe, float)
+        if len(one_sided):
+            v = xi[..., one_sided]
+            xi[..., one_sided] = sqrt((sign * v + offset) ** 2 - 1)
+        if len(both):
+            xi[..., both] = arcsin((2. * (xi[..., both] - lower[both])
+                                    / bound_range) - 1.)
         return xi
 
     return convert_e2i
 
 
-def _external2internal_lambda(bound):
-    """
-    Make a lambda function which converts an single external (constrained)
-    parameter to a internal (unconstrained) parameter.
-    """
-    lower, upper = bound
-
-    if lower is None and upper is None:  # no constraints
-        return lambda x: x
-    elif upper is None:     # only lower bound
-        return lambda x: sqrt((x - lower + 1.) ** 2 - 1)
-    elif lower is None:     # only upper bound
-        return lambda x: sqrt((upper - x + 1.) ** 2 - 1)
-    else:
-        return lambda x: arcsin((2. * (x - lower) / (upper - lower)) - 1.)
-
-
 def leastsqbound(func, x0, args=(), bounds=None, Dfun=None, full_output=0,
                  col_deriv=0, ftol=1.49012e-8, xtol=1.49012e-8,
                  gtol=0.0, maxfev=0, epsfcn=0.0, factor=100, diag=None):
@@ -242,16 +257,16 @@ def leastsqbound(func, x0, args=(), bounds=None, Dfun=None, full_output=0,
     # create function which convert between internal and external parameters
     i2e = _internal2external_func(bounds)
     e2i = _external2internal_func(bounds)
+    i2e_grad = _internal2external_grad_func(bounds)
 
     x0 = array(x0, ndmin=1)
-    i0 = e2i(x0)
     n = len(x0)
     if len(bounds) != n:
         raise ValueError('length of x0 != length of bounds')
+    i0 = e2i(x0)
     if not isinstance(args, tuple):
         args = (args,)
     m = _check_func('leastsq', 'func', func, x0, args, n)[0]
-    print(m)
     if isinstance(m, tuple):
         m = m[0]
     if n > m:
@@ -275,10 +290,16 @@ def leastsqbound(func, x0, args=(), bounds=None, Dfun=None, full_output=0,
         if (maxfev == 0):
             maxfev = 100 * (n + 1)
 
-        def wDfun(x, *args):  # wrapped Dfun
-            return Dfun(i2e(x), *args)
+        # wrapped Dfun, using the chain rule to give derivatives with
+        # respect to the internal parameters
+        def wDfun(x, *args):
+            grad = i2e_grad(x)
+            jac = array(Dfun(i2e(x), *args), dtype=float)
+            if col_deriv:
+                return jac * grad[:, None]
+            return jac * grad
 
-        retval = _minpack._lmder(func, wDfun, i0, args, full_output,
+        retval = _minpack._lmder(wfunc, wDfun, i0, args, full_output,
                                  col_deriv, ftol, xtol, gtol, maxfev, factor, diag)
 
     errors = {0: ["Improper input parameters.", TypeError],
@@ -320,7 +341,7 @@ def leastsqbound(func, x0, args=(), bounds=None, Dfun=None, full_output=0,
 
     if full_output:
         # convert fjac from internal params to external
-        grad = _internal2external_grad(retval[0], bounds)
+        grad = i2e_grad(retval[0])
         retval[1]['fjac'] = (retval[1]['fjac'].T / take(grad,
                              retval[1]['ipvt'] - 1)).T
         cov_x = None
@@ -337,3 +358,119 @@ def leastsqbound(func, x0, args=(), bounds=None, Dfun=None, full_output=0,
         return (x, cov_x) + retval[1:-1] + (mesg, info)
     else:
         return (x, info)
+
+
+def leastsqbound_multistart(func, bounds, n_starts=10, args=(),
+                            start_bounds=None, sampling="lhs",
+                            random_seed=None, target_cost=None, n_jobs=1,
+                            **kwargs):
+    """
+    Bounded least-squares minimization from many starting points.
+
+    Starting points are spread over the bounds with Latin hypercube or
+    Sobol sampling, and ``leastsqbound`` is run from each, possibly in a
+    pool of processes.
+
+    Parameters
+    ----------
+    func : callable
+        should take at least one (possibly length N vector) argument and
+        returns M floating point numbers. must be picklable (defined at
+        the top level of a module) when ``n_jobs`` is not 1.
+    bounds : list
+        ``(min, max)`` pairs for each parameter, as for ``leastsqbound``.
+    n_starts : int
+        The number of starting points.
+    args : tuple
+        Any extra arguments to func are placed in this tuple.
+    start_bounds : list
+        ``(min, max)`` pairs giving the range to draw starting values for
+        each parameter from. Defaults to ``bounds``, which must then be
+        finite.
+    sampling : lhs | sobol
+        Use a Latin hypercube or a scrambled Sobol sequence (which needs
+        scipy >= 1.7) to draw the starting points.
+    random_seed : int or None
+        Seed for drawing the starting points.
+    target_cost : float
+        If given, stop once a fit reaches a sum of squares at or below this
+        value. Fits are checked in the order of their starting points, so
+        the result does not depend on ``n_jobs``.
+    n_jobs : int
+        The number of processes to run fits in, or -1 to use all cores.
+    kwargs : key, value pairings
+        Other keyword arguments are passed to ``leastsqbound``.
+
+    Returns
+    -------
+    x : ndarray
+        The solution with the lowest sum of squares.
+    xs : ndarray
+        The solution from each starting point that was run, in order.
+    costs : ndarray
+        The sum of squares at each solution.
+
+    """
+    if start_bounds is None:
+        start_bounds = bounds
+    if len(start_bounds) != len(bounds):
+        raise ValueError('length of start_bounds != length of bounds')
+    lower, upper, _ = _bound_sets(start_bounds)
+    if not (isfinite(lower).all() and isfinite(upper).all()):
+        raise ValueError('starting points need finite bounds for every '
+                         'parameter; use start_bounds')
+    if kwargs.get('full_output'):
+        raise ValueError('full_output is not supported')
+
+    # Draw starting points in the unit cube and scale them to the bounds
+    n = len(bounds)
+    if sampling == 'lhs':
+        rs = RandomState(random_seed)
+        strata = array([rs.permutation(n_starts) for i in range(n)]).T
+        unit = (strata + rs.uniform(size=(n_starts, n))) / n_starts
+    elif sampling == 'sobol':
+        try:
+            from scipy.stats import qmc
+        except ImportError:
+            raise ImportError("sampling='sobol' needs scipy >= 1.7; "
+                              "use sampling='lhs' instead")
+        unit = qmc.Sobol(n, seed=random_seed).random(n_starts)
+    else:
+        raise ValueError("sampling must be 'lhs' or 'sobol'")
+    starts = lower + unit * (upper - lower)
+
+    tasks = [(func, x0, args, bounds, kwargs) for x0 in starts]
+    if n_jobs == -1:
+        n_jobs = multiprocessing.cpu_count()
+    if n_jobs == 1:
+        pool = None
+        results = (_multistart_fit(task) for task in tasks)
+    else:
+        pool = multiprocessing.Pool(n_jobs)
+        results = pool.imap(_multistart_fit, tasks)
+
+    xs, costs = [], []
+    try:
+        for x, cost in results:
+            xs.append(x)
+            costs.append(cost)
+            if target_cost is not None and cost <= target_cost:
+                break
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    xs, costs = array(xs), array(costs)
+    best = argmin(where(isnan(costs), inf, costs))
+    return xs[best], xs, costs
+
+
+def _multistart_fit(task):
+    """Run one fit from a multistart set (possibly in a worker)."""
+    func, x0, args, bounds, kwargs = task
+    x, _ = leastsqbound(func, x0, args, bounds, **kwargs)
+    if not isinstance(args, tuple):
+        args = (args,)
+    resid = array(func(x, *args), float).ravel()
+    return x, dot(resid, resid)
@@ -1,15 +1,26 @@
 """Assorted functions for statistical calculations."""
 from __future__ import division
+import os
+import shutil
+import tempfile
+import warnings
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import scipy as sp
-from scipy import stats
+from scipy import stats, special
 import pandas as pd
-import statsmodels.api as sm
 from sklearn.metrics import r2_score
+from sklearn.linear_model import RidgeClassifier
 from sklearn.cross_validation import (cross_val_score,
                                       LeaveOneOut, LeaveOneLabelOut)
 
 
+# Reductions that can be evaluated over a whole block of samples at once
+_axis_funcs = (np.mean, np.median, np.std, np.var, np.sum,
+               np.min, np.max, np.nanmean, np.nanmedian)
+
+
 def bootstrap(*args, **kwargs):
     """Resample one or more arrays and call a function on each sample.
 
@@ -18,49 +29,329 @@ def bootstrap(*args, **kwargs):
 
     Keyword arguments:
         n_boot : int
-            number of iterations
+            number of iterations (at least 1)
         axis : int
             will pass axis to ``func``
         smooth : bool
             if True, performs a smoothed bootstrap
             (draws samples from a kernel destiny estimate)
-            only works for one-dimensional inputs
+            by adding gaussian noise with the covariance of a
+            scott's rule kernel density estimate to each resample
         func : callable
             function to call on the args that are passed in
+        block_size : int
+            number of iterations to draw and evaluate at once. by
+            default this is chosen to keep each block of resampled
+            data to a few hundred thousand values
+        vectorized : bool
+            if True, ``func`` is called once per block on a stacked
+            array of samples, with the ``axis`` argument shifted to skip
+            the leading block dimension. only possible with a single
+            input array. the default uses this for numpy reductions
+            like ``np.mean`` and ``np.median`` on small inputs
+        summarize : bool
+            if True, return only the standard error and confidence
+            interval of the statistic, which are accumulated across
+            blocks without storing the full distribution
+        which : float
+            width of the confidence interval (in percent) when summarizing
+        n_jobs : int
+            number of workers to split blocks of iterations over, or -1
+            to use all cores
+        backend : process | thread | executor
+            type of worker pool used when ``n_jobs`` is not 1, or an
+            object with a ``map`` method, which gets a block of iterations
+            for each of its workers unless ``n_jobs`` says otherwise. with
+            processes, ``func`` must be picklable (not a lambda)
+        random_seed : int or None
+            seed for the random number generators. each block of
+            iterations draws from its own stream, so seeded results are
+            identical for any number of workers
 
     Returns
     -------
     boot_dist: array
         array of bootstrapped statistic values
+    se, ci : arrays, if ``summarize`` is True
+        standard error of the statistic and its confidence interval,
+        with the lower and upper bounds in the first dimension
 
     """
     # Ensure list of arrays are same length
-    if len(np.unique(map(len, args))) > 1:
+    if len(np.unique([len(a) for a in args])) > 1:
         raise ValueError("All input arrays must have the same length")
+    args = [np.asarray(a) for a in args]
     n = len(args[0])
 
     # Default keyword arguments
-    n_boot = kwargs.get("n_boot", 10000)
+    n_boot = int(kwargs.get("n_boot", 10000))
     func = kwargs.get("func", np.mean)
     axis = kwargs.get("axis", None)
     smooth = kwargs.get("smooth", False)
+    block_size = kwargs.get("block_size", None)
+    vectorized = kwargs.get("vectorized", None)
+    summarize = kwargs.get("summarize", False)
+    which = kwargs.get("which", 95)
+    n_jobs = kwargs.get("n_jobs", 1)
+    backend = kwargs.get("backend", "process")
+    random_seed = kwargs.get("random_seed", None)
+    if n_boot < 1:
+        raise ValueError("n_boot must be at least 1")
     if axis is None:
         func_kwargs = dict()
     else:
         func_kwargs = dict(axis=axis)
 
-    # Do the bootstrap
-    boot_dist = []
-    if smooth:
-        kde = [stats.gaussian_kde(np.transpose(a)) for a in args]
-    for i in range(int(n_boot)):
-        if smooth:
-            sample = [a.resample(n).T for a in kde]
+    # Vectorizing pays off when per-iteration overhead dominates the work
+    sample_size = sum(a.size for a in args)
+    if vectorized is None:
+        vectorized = (func in _axis_funcs and len(args) == 1 and
+                      sample_size <= 2 ** 14)
+    if block_size is None:
+        block_size = max(1, 2 ** 18 // max(sample_size, 1))
+
+    # The smoothing noise for each array has the KDE kernel covariance
+    noise = [_kde_kernel_factor(a) for a in args] if smooth else None
+
+    spec = dict(n=n, func=func, func_kwargs=func_kwargs, axis=axis,
+                noise=noise, vectorized=vectorized,
+                summarize=summarize, n_boot=n_boot, which=which)
+    n_jobs = _n_workers(n_jobs, backend)
+    groups = _iteration_blocks(n_boot, block_size, random_seed, n_jobs)
+    tasks = [(args, blocks, seeds, spec) for blocks, seeds in groups]
+    results = _parallel_map(_bootstrap_blocks, tasks, n_jobs, backend)
+
+    if summarize:
+        summary = results[0]
+        for result in results[1:]:
+            summary.merge(result)
+        return summary.se, summary.ci
+    if len(results) == 1:
+        return results[0]
+    return np.concatenate(results)
+
+
+def _bootstrap_blocks(task):
+    """Evaluate a sequence of bootstrap blocks (possibly in a worker)."""
+    args, blocks, seeds, spec = task
+    n, func, func_kwargs = spec["n"], spec["func"], spec["func_kwargs"]
+
+    n_iter = sum(n_block for _, n_block in blocks)
+    if spec["summarize"]:
+        summary = _BootstrapSummary(spec["n_boot"], spec["which"])
+    boot_dist = None
+
+    row = 0
+    for (start, n_block), seed in zip(blocks, seeds):
+        rs = np.random if seed is None else np.random.RandomState(seed)
+        resampler = rs.randint(0, n, (n_block, n))
+        samples = [a[resampler] for a in args]
+        if spec["noise"] is not None:
+            samples = [_smooth_samples(s, L, rs)
+                       for s, L in zip(samples, spec["noise"])]
+
+        if spec["vectorized"]:
+            block = _bootstrap_vectorized(samples[0], func, spec["axis"])
         else:
-            resampler = np.random.randint(0, n, n)
-            sample = [a[resampler] for a in args]
-        boot_dist.append(func(*sample, **func_kwargs))
-    return np.array(boot_dist)
+            block = [func(*[s[i] for s in samples], **func_kwargs)
+                     for i in range(n_block)]
+        block = np.asarray(block)
+
+        if spec["summarize"]:
+            summary.update(block)
+            continue
+        if boot_dist is None:
+            boot_dist = np.empty((n_iter,) + block.shape[1:], block.dtype)
+        boot_dist[row:row + n_block] = block
+        row += n_block
+
+    if spec["summarize"]:
+        return summary
+    return boot_dist
+
+
+def _iteration_blocks(n_iter, block_size, random_seed=None, n_jobs=1):
+    """Split iterations into blocks and group the blocks for each worker.
+
+    Each block gets its own random stream when seeded or run in parallel,
+    so that results do not depend on how blocks are distributed. Unseeded
+    serial runs draw from the global numpy stream (a seed of None).
+
+    Returns
+    -------
+    groups : list of (blocks, seeds) tuples
+        one per task, where each block is a (start, size) tuple
+
+    """
+    starts = np.arange(0, n_iter, block_size)
+    blocks = [(start, min(block_size, n_iter - start)) for start in starts]
+    if random_seed is None and n_jobs == 1:
+        seeds = [None for block in blocks]
+    else:
+        if random_seed is None:
+            random_seed = np.random.randint(np.iinfo(np.int32).max)
+        seeds = [[random_seed, i] for i in range(len(blocks))]
+
+    if n_jobs == -1:
+        n_jobs = multiprocessing.cpu_count()
+    splits = np.array_split(np.arange(len(blocks)),
+                            max(1, min(n_jobs, len(blocks))))
+    return [([blocks[i] for i in split], [seeds[i] for i in split])
+            for split in splits]
+
+
+def _parallel_map(func, tasks, n_jobs=1, backend="process"):
+    """Map a function over a list of tasks, possibly in a worker pool.
+
+    The backend can also be an executor object with a ``map`` method (such
+    as a ``concurrent.futures`` executor or an IPython view, whose blocking
+    ``map_sync`` is preferred), which is used regardless of ``n_jobs``.
+    With processes, ``func`` and the tasks must be picklable.
+
+    """
+    if hasattr(backend, "map"):
+        _map = getattr(backend, "map_sync", backend.map)
+        return list(_map(func, tasks))
+    if backend not in ["thread", "process"]:
+        raise ValueError("'backend' must be 'thread' or 'process'")
+    if n_jobs == -1:
+        n_jobs = multiprocessing.cpu_count()
+    if n_jobs == 1 or len(tasks) < 2:
+        return [func(task) for task in tasks]
+
+    if backend == "thread":
+        pool = ThreadPool(n_jobs)
+    else:
+        pool = multiprocessing.Pool(n_jobs)
+    try:
+        return pool.map(func, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _n_workers(n_jobs, backend):
+    """Resolve the number of batches to split work into for a backend.
+
+    An executor given with the default ``n_jobs`` of 1 gets a batch for
+    each of its workers. IPython views report their engines with ``len``,
+    but ``concurrent.futures`` executors have no public worker count, so
+    their private ``_max_workers`` attribute is read when it exists and
+    the number of cores is used otherwise. Passing any other ``n_jobs``
+    sets the number of batches explicitly.
+
+    """
+    if n_jobs == -1:
+        return multiprocessing.cpu_count()
+    if n_jobs == 1 and hasattr(backend, "map"):
+        try:
+            return len(backend)
+        except TypeError:
+            pass
+        # Not a public attribute, so fall back to the cores if it goes away
+        return getattr(backend, "_max_workers", multiprocessing.cpu_count())
+    return n_jobs
+
+
+def _bootstrap_vectorized(samples, func, axis):
+    """Evaluate a reduction over every sample in a block at once."""
+    if axis is None:
+        samples = samples.reshape(len(samples), -1)
+        return func(samples, axis=1)
+    return func(samples, axis=axis + 1 if axis >= 0 else axis)
+
+
+def _kde_kernel_factor(a):
+    """Cholesky factor of the gaussian_kde kernel covariance for rows of a."""
+    a = np.reshape(a, (len(a), -1)).astype(np.float)
+    n, d = a.shape
+    factor = n ** (-1. / (d + 4))
+    cov = np.atleast_2d(np.cov(a, rowvar=False)) * factor ** 2
+    return np.linalg.cholesky(cov)
+
+
+def _smooth_samples(samples, L, rs):
+    """Jitter a block of resamples with correlated gaussian noise."""
+    shape = samples.shape
+    n_block, n = shape[:2]
+    noise = np.dot(rs.standard_normal((n_block, n, len(L))), L.T)
+    return samples + noise.reshape(shape)
+
+
+class _BootstrapSummary(object):
+    """Accumulate the SE and CI of a bootstrap distribution over blocks.
+
+    The standard error comes from running moments, and the confidence
+    interval is exact: only the order statistics needed to interpolate
+    each percentile are kept, so memory is proportional to the tails.
+
+    """
+    def __init__(self, n_boot, which=95):
+        """Set up the accumulators for a given number of iterations."""
+        self.n_boot = n_boot
+        self.count = 0
+        self.mean = 0
+        self.m2 = 0
+
+        # Fractional rank of each bound in the full sorted distribution
+        self.ranks = (n_boot - 1) * (np.array([50 - which / 2,
+                                               50 + which / 2]) / 100)
+        self.n_lower = min(int(self.ranks[0]) + 2, n_boot)
+        self.n_upper = n_boot - int(self.ranks[1])
+        self.lower = None
+        self.upper = None
+
+    def update(self, block):
+        """Add a block of statistic values."""
+        block_mean = block.mean(axis=0)
+        block_m2 = np.square(block - block_mean).sum(axis=0)
+        self._combine(len(block), block_mean, block_m2, block, block)
+
+    def merge(self, other):
+        """Add the values accumulated by another summary."""
+        self._combine(other.count, other.mean, other.m2,
+                      other.lower, other.upper)
+
+    def _combine(self, n_new, mean, m2, lower, upper):
+        """Combine the running moments and tails with new ones."""
+        count = self.count + n_new
+        delta = mean - self.mean
+        self.mean = self.mean + delta * n_new / count
+        self.m2 = self.m2 + m2 + (np.square(delta) *
+                                  self.count * n_new / count)
+        self.count = count
+
+        # Keep the smallest and largest values that the interval needs
+        if self.lower is not None:
+            lower = np.concatenate([self.lower, lower])
+            upper = np.concatenate([self.upper, upper])
+        if len(lower) > self.n_lower:
+            lower = np.partition(lower, self.n_lower - 1, axis=0)
+            lower = lower[:self.n_lower]
+        if len(upper) > self.n_upper:
+            upper = np.partition(upper, len(upper) - self.n_upper, axis=0)
+            upper = upper[-self.n_upper:]
+        self.lower, self.upper = lower, upper
+
+    @property
+    def se(self):
+        """Standard deviation of the bootstrap distribution."""
+        return np.sqrt(self.m2 / self.count)
+
+    @property
+    def ci(self):
+        """Percentile interval, interpolated like ``percentiles``."""
+        bounds = []
+        offsets = [0, self.n_boot - self.n_upper]
+        for rank, vals, offset in zip(self.ranks, [self.lower, self.upper],
+                                      offsets):
+            vals = np.sort(vals, axis=0)
+            i = int(rank) - offset
+            frac = rank - int(rank)
+            low = vals[i]
+            high = vals[min(i + 1, len(vals) - 1)]
+            bounds.append(low + (high - low) * frac)
+        return np.array(bounds)
 
 
 def percentiles(a, pcts, axis=None):
@@ -131,8 +422,66 @@ def add_constant(a):
     return np.column_stack((a, np.ones(len(a))))
 
 
+def permutation_pvals(observed, null_dist, tail="upper"):
+    """Find p values for observed statistics under a randomization null.
+
+    The p values match those from the empirical CDF of the null, which is
+    evaluated for every test at once: a shared null is sorted once and
+    searched, and per-test nulls are compared in a single array operation.
+
+    Parameters
+    ----------
+    observed : float or array
+        observed statistic for each test
+    null_dist : array
+        either a 1d null distribution shared by all tests (e.g. a max
+        statistic distribution for corrected p values), or an n_tests x
+        n_iter array with a null distribution for each test
+    tail : upper | lower | both
+        upper gives the proportion of the null greater than the observed
+        value, lower gives the proportion less than or equal to it, and
+        both gives twice the upper tail of the absolute observed value
+
+    Returns
+    -------
+    p : float or array
+        p values with the same shape as ``observed``
+
+    """
+    if tail not in ["upper", "lower", "both"]:
+        raise ValueError("'tail' must be 'upper', 'lower', or 'both'")
+
+    observed = np.asarray(observed, np.float)
+    shape = observed.shape
+    null_dist = np.asarray(null_dist)
+    n_iter = null_dist.shape[-1]
+    if tail == "both":
+        observed = np.abs(observed)
+
+    if null_dist.ndim == 1:
+        null_dist = np.sort(null_dist)
+        cdf = np.searchsorted(null_dist, observed, "right") / n_iter
+    else:
+        null_dist = null_dist.reshape(-1, n_iter)
+        observed = observed.reshape(-1, 1)
+        cdf = (null_dist <= observed).sum(axis=-1) / n_iter
+        cdf = cdf.reshape(shape)
+
+    return _tail_pvals(cdf, tail)
+
+
+def _tail_pvals(cdf, tail):
+    """Convert null CDF values at the observed statistics to p values."""
+    if tail == "upper":
+        return 1 - cdf
+    elif tail == "lower":
+        return cdf
+    return 2 * (1 - cdf)
+
+
 def randomize_onesample(a, n_iter=10000, h_0=0, corrected=True,
-                        random_seed=None, return_dist=False):
+                        random_seed=None, return_dist=False, n_jobs=1,
+                        backend="process"):
     """Nonparametric one-sample T test through randomization.
 
     On each iteration, randomly flip the signs of the values in ``a``
@@ -156,6 +505,14 @@ def randomize_onesample(a, n_iter=10000, h_0=0, corrected=True,
         seed to use for random number generator
     return_dist : bool
         if True, return the null distribution of t statistics
+    n_jobs : int
+        number of workers to split blocks of iterations over, or -1 to
+        use all cores. results for a given seed do not depend on this
+    backend : process | thread | executor
+        type of worker pool used when ``n_jobs`` is not 1, or an object
+        with a ``map`` method, which gets a block of iterations for each of
+        its workers unless ``n_jobs`` says otherwise. threads avoid copying
+        the data to workers
 
     Returns
     -------
@@ -168,46 +525,89 @@ def randomize_onesample(a, n_iter=10000, h_0=0, corrected=True,
         if return_dist is True, the null distribution of t statistics
 
     """
-    a = np.asarray(a)
+    a = np.asarray(a, np.float)
     if a.ndim < 2:
         a = a.reshape(-1, 1)
     n_samp, n_test = a.shape
 
-    a -= h_0
-
-    rs = np.random.RandomState(random_seed)
-    flipper = (rs.uniform(size=(n_samp, n_iter)) > 0.5) * 2 - 1
-    flipper = (flipper.reshape(n_samp, 1, n_iter) *
-               np.ones((n_samp, n_test, n_iter), int))
-    rand_dist = a[:, :, None] * flipper
+    a = a - h_0
 
     err_denom = np.sqrt(n_samp - 1)
-    std_err = rand_dist.std(axis=0) / err_denom
-    t_dist = rand_dist.mean(axis=0) / std_err
-
     obs_t = a.mean(axis=0) / (a.std(axis=0) / err_denom)
+
+    # Process iterations in blocks that bound the size of the null t
+    # values held at once
+    block_size = max(1, 2 ** 20 // n_test)
+    n_jobs = _n_workers(n_jobs, backend)
+    groups = _iteration_blocks(n_iter, block_size, random_seed, n_jobs)
+    tasks = [(a, obs_t, blocks, seeds, return_dist)
+             for blocks, seeds in groups]
+    results = _parallel_map(_onesample_blocks, tasks, n_jobs, backend)
+
+    # Merge the null distributions and exceedance counts over workers
+    max_dist = np.concatenate([r[0] for r in results])
+    counts = np.sum([r[1] for r in results], axis=0)
+    if return_dist:
+        t_dist = np.concatenate([r[2] for r in results], axis=1)
+
     if corrected:
-        cdf = sm.distributions.ECDF(t_dist.max(axis=0))
-        obs_p = 1 - cdf(obs_t)
+        obs_p = permutation_pvals(obs_t, max_dist)
     else:
-        obs_p = []
-        for obs_i, null_i in zip(obs_t, t_dist):
-            cdf = sm.distributions.ECDF(null_i)
-            obs_p.append(1 - cdf(obs_i))
-        obs_p = np.array(obs_p)
+        obs_p = counts / n_iter
 
     if a.shape[1] == 1:
         obs_t = np.asscalar(obs_t)
         obs_p = np.asscalar(obs_p)
-        t_dist = t_dist.squeeze()
+        if return_dist:
+            t_dist = t_dist.squeeze()
 
     if return_dist:
         return obs_t, obs_p, t_dist
     return obs_t, obs_p
 
 
+def _onesample_blocks(task):
+    """Build part of the sign-flip null (possibly in a worker)."""
+    a, obs_t, blocks, seeds, return_dist = task
+    n_samp, n_test = a.shape
+    n_iter = sum(n_block for _, n_block in blocks)
+
+    max_dist = np.empty(n_iter)
+    counts = np.zeros(n_test, np.int)
+    t_dist = np.empty((n_test, n_iter)) if return_dist else None
+
+    row = 0
+    for (_, n_block), seed in zip(blocks, seeds):
+        rs = np.random if seed is None else np.random.RandomState(seed)
+        flipper = (rs.uniform(size=(n_block, n_samp)) > 0.5) * 2 - 1
+        t_block = _sign_flip_t(a, flipper)
+
+        # Keep only the max statistic and exceedances unless asked
+        max_dist[row:row + n_block] = t_block.max(axis=1)
+        counts += (t_block > obs_t).sum(axis=0)
+        if return_dist:
+            t_dist[:, row:row + n_block] = t_block.T
+        row += n_block
+
+    return max_dist, counts, t_dist
+
+
+def _sign_flip_t(a, flipper):
+    """One-sample t statistics for a block of sign flips of the data.
+
+    Flipping signs leaves the mean square of each test unchanged, so the
+    standard error of each flipped sample follows from its mean alone.
+
+    """
+    n_samp = len(a)
+    mean = np.dot(flipper, a) / n_samp
+    var = np.maximum(np.square(a).mean(axis=0) - np.square(mean), 0)
+    return mean / (np.sqrt(var) / np.sqrt(n_samp - 1))
+
+
 def randomize_corrmat(a, tail="both", corrected=True, n_iter=1000,
-                      random_seed=None, return_dist=False):
+                      random_seed=None, return_dist=False, n_jobs=1,
+                      backend="process"):
     """Test the significance of set of correlations with permutations.
 
     By default this corrects for multiple comparisons across one side
@@ -227,6 +627,14 @@ def randomize_corrmat(a, tail="both", corrected=True, n_iter=1000,
         seed for RNG
     return_dist : bool
         if True, return n_vars x n_vars x n_iter
+    n_jobs : int
+        number of workers to split blocks of iterations over, or -1 to
+        use all cores. results for a given seed do not depend on this
+    backend : process | thread | executor
+        type of worker pool used when ``n_jobs`` is not 1, or an object
+        with a ``map`` method, which gets a block of iterations for each of
+        its workers unless ``n_jobs`` says otherwise. threads avoid copying
+        the data to workers
 
     Returns
     -------
@@ -237,77 +645,143 @@ def randomize_corrmat(a, tail="both", corrected=True, n_iter=1000,
     if tail not in ["upper", "lower", "both"]:
         raise ValueError("'tail' must be 'upper', 'lower', or 'both'")
 
-    rs = np.random.RandomState(random_seed)
-
-    a = np.asarray(a)
-    flat_a = a.ravel()
+    a = np.asarray(a, np.float)
     n_vars, n_obs = a.shape
 
-    # Do the permutations to establish a null distribution
-    null_dist = np.empty((n_vars, n_vars, n_iter))
-    for i_i in range(n_iter):
-        perm_i = np.concatenate([rs.permutation(n_obs) + (v * n_obs)
-                                 for v in range(n_vars)])
-        a_i = flat_a[perm_i].reshape(n_vars, n_obs)
-        null_dist[..., i_i] = np.corrcoef(a_i)
-
-    # Get the observed correlation values
-    real_corr = np.corrcoef(a)
+    # Standardize once so that each correlation is a scaled dot product
+    z = (a - a.mean(axis=1, keepdims=True)) / a.std(axis=1, keepdims=True)
+    upper_tri = np.triu_indices(n_vars, 1)
+    observed = np.dot(z, z.T)[upper_tri] / n_obs
+
+    # Permute in blocks of iterations sized to bound the memory held for
+    # the permuted data and their correlation matrices at once
+    block_size = max(1, 2 ** 22 // (n_vars * (n_vars + n_obs)))
+    n_jobs = _n_workers(n_jobs, backend)
+    groups = _iteration_blocks(n_iter, block_size, random_seed, n_jobs)
+    tasks = [(z, observed, tail, blocks, seeds, return_dist)
+             for blocks, seeds in groups]
+    results = _parallel_map(_corrmat_blocks, tasks, n_jobs, backend)
+
+    # Merge the null distributions and counts over workers
+    max_dist = np.concatenate([r[0] for r in results])
+    counts = np.sum([r[1] for r in results], axis=0)
+    if return_dist:
+        pair_dist = np.concatenate([r[2] for r in results], axis=1)
 
     # Figure out p values based on the permutation distribution
     p_mat = np.zeros((n_vars, n_vars))
-    upper_tri = np.triu_indices(n_vars, 1)
-
     if corrected:
         if tail == "both":
-            max_dist = np.abs(null_dist[upper_tri]).max(axis=0)
-        elif tail == "lower":
-            max_dist = null_dist[upper_tri].min(axis=0)
-        elif tail == "upper":
-            max_dist = null_dist[upper_tri].max(axis=0)
-
-        cdf = sm.distributions.ECDF(max_dist)
-
-        for i, j in zip(*upper_tri):
-            observed = real_corr[i, j]
-            if tail == "both":
-                p_ij = 1 - cdf(abs(observed))
-            elif tail == "lower":
-                p_ij = cdf(observed)
-            elif tail == "upper":
-                p_ij = 1 - cdf(observed)
-            p_mat[i, j] = p_ij
-
+            p_mat[upper_tri] = permutation_pvals(np.abs(observed), max_dist)
+        else:
+            p_mat[upper_tri] = permutation_pvals(observed, max_dist, tail)
     else:
-        for i, j in zip(*upper_tri):
-
-            null_corrs = null_dist[i, j]
-            cdf = sm.distributions.ECDF(null_corrs)
-
-            observed = real_corr[i, j]
-            if tail == "both":
-                p_ij = 2 * (1 - cdf(abs(observed)))
-            elif tail == "lower":
-                p_ij = cdf(observed)
-            elif tail == "upper":
-                p_ij = 1 - cdf(observed)
-            p_mat[i, j] = p_ij
+        p_mat[upper_tri] = _tail_pvals(counts / n_iter, tail)
 
     # Make p matrix symettrical with nans on the diagonal
     p_mat += p_mat.T
     p_mat[np.diag_indices(n_vars)] = np.nan
 
     if return_dist:
+        null_dist = np.empty((n_vars, n_vars, n_iter))
+        null_dist[upper_tri] = pair_dist
+        null_dist[upper_tri[::-1]] = pair_dist
+        null_dist[np.diag_indices(n_vars)] = 1
         return p_mat, null_dist
     return p_mat
 
 
+def _corrmat_blocks(task):
+    """Build part of the correlation permutation null (possibly in a worker).
+
+    Only the max statistic of each iteration and the number of iterations
+    at or below each observed correlation (its absolute value for a two
+    tailed test) are kept, unless the full null is asked for.
+
+    """
+    z, observed, tail, blocks, seeds, return_dist = task
+    n_vars, n_obs = z.shape
+    n_iter = sum(n_block for _, n_block in blocks)
+    rows, cols = np.triu_indices(n_vars, 1)
+    var_index = np.arange(n_vars)[:, np.newaxis]
+    if tail == "both":
+        observed = np.abs(observed)
+
+    max_dist = np.empty(n_iter)
+    counts = np.zeros(len(rows), np.int)
+    pair_dist = np.empty((len(rows), n_iter)) if return_dist else None
+
+    row = 0
+    for (_, n_block), seed in zip(blocks, seeds):
+        # Shuffle each variable independently through one index block
+        rs = np.random if seed is None else np.random.RandomState(seed)
+        perm = rs.uniform(size=(n_block, n_vars, n_obs)).argsort(axis=-1)
+        z_block = z[var_index, perm]
+        r_block = np.matmul(z_block, z_block.transpose(0, 2, 1))
+        r_block = r_block[:, rows, cols] / n_obs
+
+        if return_dist:
+            pair_dist[:, row:row + n_block] = r_block.T
+        counts += (r_block <= observed).sum(axis=0)
+        if tail == "both":
+            max_dist[row:row + n_block] = np.abs(r_block).max(axis=1)
+        elif tail == "lower":
+            max_dist[row:row + n_block] = r_block.min(axis=1)
+        else:
+            max_dist[row:row + n_block] = r_block.max(axis=1)
+        row += n_block
+
+    return max_dist, counts, pair_dist
+
+
+def permute_within_runs(runs, n_iter=1, random_seed=None):
+    """Draw random permutations that only exchange samples within runs.
+
+    Parameters
+    ----------
+    runs : array-like
+        run label for each sample. labels can be of any type, and the
+        samples in a run do not need to be contiguous
+    n_iter : int
+        number of permutations to draw
+    random_seed : int or None
+        seed for random number generator
+
+    Returns
+    -------
+    perms : n_iter x n_samples array
+        each row indexes the samples so that ``y[perms[i]]`` shuffles ``y``
+        within each run
+
+    """
+    _, run_codes = np.unique(runs, return_inverse=True)
+    n_samples = len(run_codes)
+    rs = np.random.RandomState(random_seed)
+
+    # Sample positions grouped by run, in their original order
+    run_slots = np.argsort(run_codes, kind="mergesort")
+
+    # Sorting on random keys within each run gives a block of shuffled
+    # samples grouped by run, which fill the grouped positions
+    keys = rs.uniform(size=(n_iter, n_samples))
+    codes = np.tile(run_codes, (n_iter, 1))
+    shuffled = np.lexsort((keys, codes), axis=-1)
+    perms = np.empty_like(shuffled)
+    perms[:, run_slots] = shuffled
+    return perms
+
+
 def randomize_classifier(data, model, n_iter=1000, cv_method="run",
-                         random_seed=None, return_dist=False, dv=None):
+                         random_seed=None, return_dist=False, dv=None,
+                         n_jobs=1, backend="process", memmap=None):
     """Randomly shuffle class labels to build a null distribution of accuracy.
 
-    Randimization can be distributed over an IPython cluster using the ``dv``
-    argument. Otherwise, it runs in serial.
+    The permutations are split into ``n_jobs`` batches, each of which is
+    sent to a worker along with one copy of the data and evaluated at every
+    timepoint. Batches can run in a local thread or process pool, through
+    any executor with a ``map`` method (e.g. from ``concurrent.futures``),
+    or over an IPython cluster using the ``dv`` argument. Otherwise, it
+    runs in serial.
 
     Parameters
     ----------
@@ -326,7 +800,23 @@ def randomize_classifier(data, model, n_iter=1000, cv_method="run",
     return_dist : bool
         if True, return null distribution
     dv : IPython direct view
-        view onto IPython cluster for parallel execution over iterations
+        view onto IPython cluster for parallel execution over iterations;
+        shorthand for passing it as ``backend``
+    n_jobs : int
+        number of batches to split the permutations into, which is also the
+        number of workers for a local pool, or -1 to use all cores. with an
+        executor or ``dv``, defaults to the number of engines in the view
+        or workers in the executor (or cores, if it does not say); pass a
+        different value to set the number of batches explicitly
+    backend : process | thread | executor
+        local worker pool type, or an object with a ``map`` method that
+        batches are distributed through. with processes or a cluster, the
+        model must be picklable
+    memmap : bool or None
+        if True, write the features to a temporary file that workers
+        memory-map, so only the permutation indices are sent to them. this
+        requires workers that share a filesystem with the caller. by
+        default, it is used with a local process pool
 
     Returns
     -------
@@ -337,15 +827,9 @@ def randomize_classifier(data, model, n_iter=1000, cv_method="run",
         array of null model scores, only if asked for it
 
     """
-    if dv is None:
-        try:
-            import __builtin__
-            _map = __builtin__.map
-        except ImportError:
-            import builtins
-            _map = builtins.map
-    else:
-        _map = dv.map_sync
+    if dv is not None:
+        backend = dv
+    n_jobs = _n_workers(n_jobs, backend)
 
     # Set up the data properly
     X = data["X"]
@@ -358,51 +842,172 @@ def randomize_classifier(data, model, n_iter=1000, cv_method="run",
     else:
         cv = cv_method
     if X.ndim < 3:
-        X = [X]
-
-    def _perm_decode(model, X, y, cv, perm):
-        """Internal func for parallel purposes."""
-        y_perm = y[perm]
-        perm_acc = cross_val_score(model, X, y_perm, cv=cv).mean()
-        return perm_acc
-
-    # Make lists to send into map()
-    model_p = [model for i in range(n_iter)]
-    y_p = [y for i in range(n_iter)]
-    cv_p = [cv for i in range(n_iter)]
+        X = X[np.newaxis]
 
     # Permute within run
-    rs = np.random.RandomState(random_seed)
-    perms = []
-    for i in range(n_iter):
-        perm_i = []
-        for run in np.unique(runs):
-            perm_r = rs.permutation(np.sum(runs == run))
-            perm_r += np.sum(runs == run - 1)
-            perm_i.append(perm_r)
-        perms.append(np.concatenate(perm_i))
-
-    # Actually do the permutations, possibly in parallel
-    null_dist = []
-    for X_i in X:
-        X_p = [X_i for i in range(n_iter)]
-        tr_scores = list(_map(_perm_decode, model_p, X_p, y_p, cv_p, perms))
-        null_dist.append(tr_scores)
-    null_dist = np.array(null_dist).T
+    perms = permute_within_runs(runs, n_iter, random_seed)
+
+    # Actually do the permutations, possibly in parallel, sending the data
+    # once with each batch of permutations
+    splits = np.array_split(np.arange(n_iter), max(1, min(n_jobs, n_iter)))
+    if memmap is None:
+        memmap = backend == "process" and n_jobs != 1 and len(splits) > 1
+    temp_dir = tempfile.mkdtemp() if memmap else None
+    try:
+        if memmap:
+            X_arg = os.path.join(temp_dir, "X.npy")
+            np.save(X_arg, np.asarray(X))
+        else:
+            X_arg = X
+        perms = np.asarray(perms)
+        tasks = [(model, X_arg, y, cv, perms[split]) for split in splits]
+        results = _parallel_map(_classifier_null, tasks, n_jobs, backend)
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir)
+    null_dist = np.concatenate(results)
 
     # Calculate a p value for each TR
-    p_vals = []
-    for i, dist_i in enumerate(null_dist.T):
-        acc_i = cross_val_score(model, X[i], y, cv=cv).mean()
-        cdf_i = sm.distributions.ECDF(dist_i)
-        p_vals.append(1 - cdf_i(acc_i))
-    p_vals = np.array(p_vals)
+    acc = np.array([cross_val_score(model, X_i, y, cv=cv).mean()
+                    for X_i in X])
+    p_vals = permutation_pvals(acc, null_dist.T)
 
     if return_dist:
         return p_vals, null_dist
     return p_vals
 
 
+def _classifier_null(task):
+    """Score a batch of label permutations (possibly in a worker).
+
+    The features may be given as the path to an array file, which is
+    memory-mapped so that workers share one copy of the data.
+
+    """
+    model, X, y, cv, perms = task
+    if isinstance(X, str):
+        X = np.load(X, mmap_mode="r")
+
+    null_dist = _ridge_null(model, X, y, cv, perms)
+    if null_dist is not None:
+        return null_dist
+
+    null_dist = np.empty((len(perms), len(X)))
+    for i, perm in enumerate(perms):
+        y_perm = y[perm]
+        for j, X_j in enumerate(X):
+            null_dist[i, j] = cross_val_score(model, X_j, y_perm,
+                                              cv=cv).mean()
+    return null_dist
+
+
+_ridge_linear_params = ["alpha", "fit_intercept", "solver", "copy_X", "tol",
+                        "max_iter", "random_state", "normalize"]
+_ridge_inactive_params = dict(class_weight=None, positive=False)
+
+
+def _ridge_null(model, X, y, cv, perms):
+    """Score permuted labels for a ridge classifier as a batch.
+
+    The ridge solution is linear in the labels, so the map from training
+    labels to test set decision values in each fold does not depend on the
+    permutation. It is computed once per fold and applied to every
+    permuted label vector at once. Returns None when the model or cross
+    validation scheme is not supported, so that the caller can fall back
+    to refitting on each permutation.
+
+    """
+    if not isinstance(model, RidgeClassifier):
+        return None
+    # Only settings known to give a solution that is linear in the labels
+    # are batched; anything else (e.g. a positivity constraint or settings
+    # from newer versions of scikit-learn) is refit on each permutation
+    params = model.get_params()
+    for name, value in params.items():
+        if name in _ridge_linear_params:
+            continue
+        if name not in _ridge_inactive_params:
+            return None
+        if value != _ridge_inactive_params[name]:
+            return None
+    if (params.get("normalize")
+            or params.get("solver") not in ["auto", "cholesky", "svd"]
+            or np.ndim(params["alpha"])):
+        return None
+    try:
+        folds = [(_fold_index(train, len(y)), _fold_index(test, len(y)))
+                 for train, test in cv]
+    except (TypeError, ValueError):
+        return None
+
+    # Every training fold needs every class for the label coding to be
+    # the same across permutations
+    classes, y_codes = np.unique(y, return_inverse=True)
+    n_classes = len(classes)
+    if n_classes < 2:
+        return None
+    y_perm = y_codes[np.asarray(perms)]
+    for train, _ in folds:
+        present = y_perm[:, train, np.newaxis] == np.arange(n_classes)
+        if not present.any(axis=1).all():
+            return None
+
+    # Code labels as +1/-1 indicators, with one column for binary problems
+    if n_classes == 2:
+        Y = (y_perm[..., np.newaxis] == 1) * 2. - 1
+    else:
+        Y = (y_perm[..., np.newaxis] == np.arange(n_classes)) * 2. - 1
+
+    alpha = params["alpha"]
+    intercept = params["fit_intercept"]
+    null_dist = np.zeros((len(perms), len(X)))
+    for j, X_j in enumerate(X):
+        X_j = np.asarray(X_j, np.float)
+        for train, test in folds:
+            X_train, X_test = X_j[train], X_j[test]
+            Y_train = Y[:, train]
+            if intercept:
+                X_mean = X_train.mean(axis=0)
+                X_train = X_train - X_mean
+                X_test = X_test - X_mean
+                Y_mean = Y_train.mean(axis=1, keepdims=True)
+                Y_train = Y_train - Y_mean
+
+            # Hat matrix from training labels to test decision values,
+            # solved in whichever of the primal or dual is smaller
+            n_train, n_feat = X_train.shape
+            if n_feat <= n_train:
+                gram = np.dot(X_train.T, X_train)
+                gram.flat[::n_feat + 1] += alpha
+                hat = np.dot(X_test, np.linalg.solve(gram, X_train.T))
+            else:
+                gram = np.dot(X_train, X_train.T)
+                gram.flat[::n_train + 1] += alpha
+                hat = np.linalg.solve(gram, np.dot(X_train, X_test.T)).T
+
+            dec = np.einsum("ij,pjk->pik", hat, Y_train)
+            if intercept:
+                dec += Y_mean
+            if n_classes == 2:
+                pred = (dec[..., 0] > 0).astype(np.int)
+            else:
+                pred = dec.argmax(axis=-1)
+            null_dist[:, j] += (pred == y_perm[:, test]).mean(axis=1)
+        null_dist[:, j] /= len(folds)
+
+    return null_dist
+
+
+def _fold_index(index, n):
+    """Convert a cross-validation mask or index array to indices."""
+    index = np.asarray(index)
+    if index.dtype == bool:
+        if len(index) != n:
+            raise ValueError("Fold mask does not match the data")
+        return np.flatnonzero(index)
+    return index
+
+
 def transition_probabilities(sched):
     """Return probability of moving from row trial to col trial.
 
@@ -415,21 +1020,51 @@ def transition_probabilities(sched):
     -------
     trans_probs : pandas DataFrame
 
+    """
+    trial_types, codes = np.unique(np.asarray(sched), return_inverse=True)
+    trans_probs = transition_matrix(codes, len(trial_types))
+    return pd.DataFrame(trans_probs, index=trial_types, columns=trial_types)
+
+
+def transition_matrix(sched, n_types=None):
+    """Find transition probabilities for one or more integer-coded schedules.
+
+    Parameters
+    ----------
+    sched : length or n_schedules x length array of ints
+        event schedule(s), with trial types coded from 0 to n_types - 1
+    n_types : int, optional
+        number of trial types; inferred from the largest code if absent
+
+    Returns
+    -------
+    trans_probs : n_types x n_types or n_schedules x n_types x n_types array
+        probability of moving from the row trial type to the column trial
+        type in each schedule. rows for types that never precede another
+        trial are nan
+
     """
     sched = np.asarray(sched)
-    trial_types = np.sort(np.unique(sched))
-    n_types = len(trial_types)
-    trans_probs = pd.DataFrame(columns=trial_types, index=trial_types)
+    single = sched.ndim == 1
+    sched = np.atleast_2d(sched)
+    if n_types is None:
+        n_types = sched.max() + 1
+    if sched.size and (sched.min() < 0 or sched.max() >= n_types):
+        raise ValueError("Schedule codes must be between 0 and n_types - 1")
+    n_sched = len(sched)
+
+    # Count every (schedule, previous, next) triplet with one bincount
+    offsets = np.arange(n_sched)[:, np.newaxis] * n_types ** 2
+    pairs = offsets + sched[:, :-1] * n_types + sched[:, 1:]
+    counts = np.bincount(pairs.ravel(), minlength=n_sched * n_types ** 2)
+    counts = counts.reshape(n_sched, n_types, n_types)
 
-    for type in trial_types:
-        type_probs = pd.Series(np.zeros(n_types), index=trial_types)
-        idx, = np.nonzero(sched[:-1] == type)
-        idx += 1
-        type_probs.update(pd.value_counts(sched[idx]))
-        trans_probs[type] = type_probs
+    with np.errstate(divide="ignore", invalid="ignore"):
+        trans_probs = counts / counts.sum(axis=-1, keepdims=True)
 
-    trans_probs = trans_probs.divide(pd.value_counts(sched[:-1]))
-    return trans_probs.T
+    if single:
+        return trans_probs[0]
+    return trans_probs
 
 
 class GammaHRF(object):
@@ -485,14 +1120,23 @@ class GammaHRF(object):
         self : reference to self
 
         """
+        x = np.asarray(x, np.float)
+        y = np.asarray(y, np.float)
+
         def _objective(vals):
 
             shape, loc, scale, coef, baseline = vals
-            pdf = stats.gamma(shape, loc, scale).pdf(x)
+            pdf = _gamma_pdf(x, shape, loc, scale)
             pdf *= coef
             pdf += baseline
             return y - pdf
 
+        def _jacobian(vals):
+
+            shape, loc, scale, coef, baseline = vals
+            _, jac = _gamma_hrf_jacobian(x, shape, loc, scale, coef)
+            return -jac
+
         shape, loc, scale, coef, baseline = self.starting_vals
         if baseline is None:
             baseline = np.min(y)
@@ -500,20 +1144,21 @@ class GammaHRF(object):
         if coef is None:
             y_range = np.max(y) - baseline
             starting_mode = (shape - 1) * scale + loc
-            gamma_rv = stats.gamma(shape, loc, scale)
-            starting_peak = gamma_rv.pdf(starting_mode)
+            starting_peak = _gamma_pdf(starting_mode, shape, loc, scale)
             coef = y_range / starting_peak
 
         starting_vals = [shape, loc, scale, coef, baseline]
         if self.bounds is None:
             optim_vals, _ = sp.optimize.leastsq(_objective,
                                                 starting_vals,
+                                                Dfun=_jacobian,
                                                 maxfev=maxfev)
         else:
             from moss import leastsqbound
             optim_vals, _ = leastsqbound.leastsqbound(_objective,
                                                       starting_vals,
                                                       bounds=self.bounds,
+                                                      Dfun=_jacobian,
                                                       maxfev=maxfev)
 
         shape, loc, scale, coef, baseline = optim_vals
@@ -525,6 +1170,135 @@ class GammaHRF(object):
         self.fit_r2_ = self.r2_score(x, y)
         return self
 
+    def fit_many(self, x, Y, max_iter=500, tol=1e-4, chunk_size=10000,
+                 check_fits=False):
+        """Fit a separate function to many timecourses at once.
+
+        Uses Levenberg-Marquardt iterations that are vectorized over
+        timecourses, with the gamma pdf and its derivatives in closed form.
+        Each step may change shape, loc, and scale by at most half their
+        size (or by half a unit when they are smaller than one). If there
+        are bounds, the parameters are clipped into them at each step.
+
+        Every timecourse is fit from the starting values and again from a
+        start with its mode at the largest observation. Fits that end with
+        a shape below 2, where the gamma rises steeply from its onset and
+        the iterations can get caught with loc on a sample time, are
+        restarted with loc moved a sample either way. The solution with
+        the smallest sum of squares is kept. The fitted attributes become
+        arrays with one entry for each timecourse.
+
+        Parameters
+        ----------
+        x : 1d array
+            timepoints (in seconds)
+        Y : n_timepoints x n_timecourses array
+            observed data values
+        max_iter : int, optional
+            maximum number of iterations
+        tol : float, optional
+            relative reduction in the sum of squares over the last ten
+            iterations below which a timecourse is considered converged
+        chunk_size : int, optional
+            number of timecourses to fit at once
+        check_fits : bool, optional
+            if True, timecourses whose batched fit did not converge or
+            ended with a shape below 2 are also fit on their own with
+            `fit`, keeping the solution with the smaller sum of squares.
+            this is much slower on noisy data, where such fits are common
+
+        Returns
+        -------
+        self : reference to self
+
+        """
+        x = np.asarray(x, np.float)
+        Y = np.asarray(Y, np.float)
+        if Y.ndim == 1:
+            Y = Y[:, np.newaxis]
+        if len(Y) != len(x):
+            raise ValueError("Y must have a row for each timepoint")
+
+        params = np.empty((Y.shape[1], 5))
+        for start in range(0, Y.shape[1], chunk_size):
+            Y_chunk = Y[:, start:start + chunk_size].T
+            params[start:start + chunk_size] = self._fit_chunk(
+                x, Y_chunk, max_iter, tol, check_fits)
+
+        self.shape_, self.loc_, self.scale_, self.coef_, self.baseline_ = \
+            params.T
+        hrf = self.predict(x)
+        ss_res = np.square(Y - hrf).sum(axis=0)
+        ss_tot = np.square(hrf - hrf.mean(axis=0)).sum(axis=0)
+        self.fit_r2_ = 1 - ss_res / ss_tot
+        return self
+
+    def _fit_chunk(self, x, Y, max_iter, tol, check_fits):
+        """Fit the rows of Y at once from several starts."""
+        def _refit(rows, vals):
+            new_vals, new_cost, new_unfinished = _fit_gamma_lm(
+                x, Y[rows], vals, self.bounds, max_iter, tol)
+            better = new_cost < cost[rows]
+            best_vals[rows[better]] = new_vals[better]
+            cost[rows[better]] = new_cost[better]
+            unfinished[rows[better]] = new_unfinished[better]
+            return better
+
+        best_vals, cost, unfinished = _fit_gamma_lm(
+            x, Y, self._starting_array(Y), self.bounds, max_iter, tol)
+
+        # Start again with the mode of the gamma at the largest observation
+        loc, scale = self.starting_vals[1:3]
+        peak_time = x[np.argmax(Y, axis=1)]
+        shape = np.maximum((peak_time - loc) / scale + 1, 2)
+        _refit(np.arange(len(Y)), self._starting_array(Y, shape))
+
+        # Move low-shape fits across the nearest sample times
+        spacing = np.median(np.diff(np.sort(x)))
+        for i in range(3):
+            rows = np.flatnonzero(best_vals[:, 0] < 2)
+            moved = np.zeros(len(rows), bool)
+            for shift in [-spacing, spacing]:
+                vals = best_vals[rows].copy()
+                vals[:, 1] += shift
+                moved |= _refit(rows, vals)
+            if not moved.any():
+                break
+
+        if not check_fits:
+            return best_vals
+
+        doubtful = unfinished | (best_vals[:, 0] < 2)
+        single = GammaHRF(*self.starting_vals)
+        single.bounds = self.bounds
+        for i in np.flatnonzero(doubtful):
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)
+                single.fit(x, Y[i])
+            single_cost = np.square(Y[i] - single.predict(x)).sum()
+            if single_cost < cost[i]:
+                best_vals[i] = (single.shape_, single.loc_, single.scale_,
+                                single.coef_, single.baseline_)
+        return best_vals
+
+    def _starting_array(self, Y, shape=None):
+        """Starting values for each row in an array of timecourses."""
+        start_shape, loc, scale, coef, baseline = self.starting_vals
+        if shape is None:
+            shape = start_shape
+        if baseline is None:
+            baseline = Y.min(axis=1)
+        if coef is None:
+            y_range = Y.max(axis=1) - baseline
+            starting_mode = (shape - 1) * scale + loc
+            coef = y_range / _gamma_pdf(starting_mode, shape, loc, scale)
+        vals = np.empty((len(Y), 5))
+        vals[:] = start_shape, loc, scale, 0, 0
+        vals[:, 0] = shape
+        vals[:, 3] = coef
+        vals[:, 4] = baseline
+        return vals
+
     def predict(self, x):
         """Using fit values, predict heights for new timepoints.
 
@@ -536,10 +1310,14 @@ class GammaHRF(object):
         Returns
         -------
         hrf : array
-            predicted heights at each timepoint
+            predicted heights at each timepoint, with a column for each
+            timecourse if fit to many at once
 
         """
-        hrf = stats.gamma(self.shape_, self.loc_, self.scale_).pdf(x)
+        x = np.asarray(x, np.float)
+        if np.ndim(self.shape_):
+            x = x[:, np.newaxis]
+        hrf = _gamma_pdf(x, self.shape_, self.loc_, self.scale_)
         hrf *= self.coef_
         hrf += self.baseline_
         return hrf
@@ -552,6 +1330,143 @@ class GammaHRF(object):
     @property
     def peak_time_(self):
         """Use fit parameters to predict time to peak."""
+        if np.ndim(self.shape_):
+            peak = (self.shape_ - 1) * self.scale_ + self.loc_
+            return np.where(self.shape_ > 1, peak, self.loc_)
         if self.shape_ > 1:
             return (self.shape_ - 1) * self.scale_ + self.loc_
         return self.loc_
+
+
+def _gamma_pdf(x, shape, loc, scale):
+    """Gamma pdf evaluated in log space, broadcasting over parameters.
+
+    As with scipy.stats.gamma, the pdf is nan for invalid parameters.
+
+    """
+    t = (x - loc) / scale
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_pdf = (special.xlogy(shape - 1, t) - t
+                   - special.gammaln(shape) - np.log(scale))
+        pdf = np.where(t >= 0, np.exp(log_pdf), 0)
+    valid = (np.asarray(shape) > 0) & (np.asarray(scale) > 0)
+    return np.where(valid, pdf, np.nan)
+
+
+def _gamma_hrf_jacobian(x, shape, loc, scale, coef):
+    """Derivatives of a scaled gamma pdf plus baseline in its parameters.
+
+    Returns the pdf and an array with the partial derivatives with respect
+    to shape, loc, scale, coef, and baseline on the last axis.
+
+    """
+    pdf = _gamma_pdf(x, shape, loc, scale)
+    t = (x - loc) / scale
+    pos = t > 0
+    t_pos = np.where(pos, t, 1)
+
+    # Derivatives of the log pdf, which are zero where the pdf is
+    d_shape = np.log(t_pos) - special.digamma(shape)
+    d_loc = (1 - (shape - 1) / t_pos) / scale
+    d_scale = (t_pos - shape) / scale
+    scaled = np.where(pos, coef * pdf, 0)
+
+    jac = np.empty(np.shape(pdf) + (5,))
+    jac[..., 0] = scaled * d_shape
+    jac[..., 1] = scaled * d_loc
+    jac[..., 2] = scaled * d_scale
+    jac[..., 3] = pdf
+    jac[..., 4] = 1
+    return pdf, jac
+
+
+def _fit_gamma_lm(x, Y, vals, bounds=None, max_iter=100, tol=1e-4,
+                  max_step=.5, window=10):
+    """Levenberg-Marquardt fits of the gamma HRF to each row of Y at once.
+
+    A row converges once its sum of squares has fallen by less than `tol`
+    (relative) over the last `window` iterations, or once steps keep
+    failing. Returns the parameters, their sums of squares, and a mask of
+    rows that had not converged after `max_iter` iterations.
+
+    """
+    vals = vals.copy()
+    if bounds is None:
+        lower, upper = None, None
+    else:
+        lower = np.array([-np.inf if b is None else b for b, _ in bounds])
+        upper = np.array([np.inf if b is None else b for _, b in bounds])
+        vals = np.clip(vals, lower, upper)
+
+    def _cost(vals, Y):
+        shape, loc, scale, coef, baseline = vals.T[..., np.newaxis]
+        pdf = _gamma_pdf(x, shape, loc, scale)
+        cost = np.square(Y - coef * pdf - baseline).sum(axis=1)
+        return np.where(np.isfinite(cost), cost, np.inf)
+
+    cost = _cost(vals, Y)
+    history = np.tile(cost[:, np.newaxis], (1, window))
+    damping = np.full(len(Y), 1e-3)
+    active = np.isfinite(cost)
+    for i in range(max_iter):
+        if not active.any():
+            break
+        idx = np.flatnonzero(active)
+        shape, loc, scale, coef, baseline = vals[idx].T[..., np.newaxis]
+        pdf, jac = _gamma_hrf_jacobian(x, shape, loc, scale, coef)
+        resid = Y[idx] - coef * pdf - baseline
+
+        # Damped normal equations, scaled by the curvature of each
+        # parameter so that the step is invariant to parameter units
+        jtj = np.einsum("nti,ntj->nij", jac, jac)
+        jtr = np.einsum("nti,nt->ni", jac, resid)
+        diag = np.einsum("nii->ni", jtj)
+        diag = np.maximum(diag, 1e-12 * diag.max(axis=1, keepdims=True))
+        lhs = jtj + (damping[idx, np.newaxis] * diag)[..., np.newaxis] \
+            * np.eye(5)
+
+        # Hold parameters that are at a bound and pushed outward fixed
+        if bounds is not None:
+            held = (((vals[idx] <= lower) & (jtr < 0))
+                    | ((vals[idx] >= upper) & (jtr > 0)))
+            free = ~held
+            lhs *= free[:, :, np.newaxis] & free[:, np.newaxis, :]
+            lhs[held[..., np.newaxis] * np.eye(5, dtype=bool)] = 1
+            jtr[held] = 0
+        try:
+            step = np.linalg.solve(lhs, jtr[..., np.newaxis])[..., 0]
+        except np.linalg.LinAlgError:
+            step = np.array([np.linalg.lstsq(l, r, rcond=-1)[0]
+                             for l, r in zip(lhs, jtr)])
+
+        # Shrink steps that would move shape, loc, or scale by more than
+        # a fraction of their current size so that one accepted step
+        # cannot jump into an unrelated basin
+        limit = max_step * np.maximum(np.abs(vals[idx, :3]), 1)
+        ratio = np.abs(step[:, :3]) / limit
+        step /= np.maximum(ratio.max(axis=1), 1)[:, np.newaxis]
+
+        new_vals = vals[idx] + step
+        if bounds is not None:
+            new_vals = np.clip(new_vals, lower, upper)
+        new_cost = _cost(new_vals, Y[idx])
+
+        # Accept improving steps and relax the damping for them, keeping
+        # enough damping that a failed step is recovered from quickly
+        better = new_cost < cost[idx]
+        vals[idx[better]] = new_vals[better]
+        cost[idx[better]] = new_cost[better]
+        damping[idx] = np.where(better, np.maximum(damping[idx] / 10, 1e-7),
+                                damping[idx] * 10)
+
+        # Stop rows whose cost has levelled off, which includes rows
+        # drifting along the valley where the gamma tends to a gaussian
+        # (shape growing as loc falls) that has no finite minimum
+        previous = history[idx, i % window]
+        history[idx, i % window] = cost[idx]
+        done = (damping[idx] > 1e10) | (cost[idx] == 0)
+        if i + 1 >= window:
+            done |= previous - cost[idx] <= tol * cost[idx]
+        active[idx[done]] = False
+
+    return vals, cost, active
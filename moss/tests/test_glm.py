@@ -1,6 +1,10 @@
+import os
+import shutil
+import tempfile
+import threading
 import numpy as np
 import pandas as pd
-from scipy import signal
+from scipy import signal, linalg, stats
 from sklearn.decomposition import PCA
 
 import nose.tools as nt
@@ -114,6 +118,52 @@ def test_hrf_names():
     nt.assert_equal(conv4.columns.tolist(), ["donna", "donna_deriv"])
 
 
+def test_hrf_convolve_matrix():
+    """Test that convolving a matrix matches convolving each column."""
+    data = (np.random.rand(500, 3) < .2).astype(int)
+    names = ["josh", "toby", "sam"]
+
+    for hrf in [glm.GammaDifferenceHRF(),
+                glm.GammaDifferenceHRF(temporal_deriv=True)]:
+        conv = hrf.convolve_matrix(data, names=names)
+        for i, name in enumerate(names):
+            conv_i = hrf.convolve(data[:, i], name=name)
+            npt.assert_array_almost_equal(conv[conv_i.columns], conv_i)
+            npt.assert_array_equal(conv.index.values, conv_i.index.values)
+
+    hrf = glm.GammaDifferenceHRF(temporal_deriv=True)
+    conv = hrf.convolve_matrix(pd.DataFrame(data, columns=names))
+    nt.assert_equal(conv.columns.tolist(),
+                    names + ["josh_deriv", "toby_deriv", "sam_deriv"])
+
+
+def test_hrf_fft_convolution():
+    """Test that FFT convolution matches direct convolution."""
+    data = np.random.randn(1000, 4)
+    data[:, 0] = np.random.rand(1000) < .1
+    for deriv in [False, True]:
+        for kernel_secs in [2, 32, 64]:
+            kws = dict(temporal_deriv=deriv, kernel_secs=kernel_secs)
+            hrf_direct = glm.GammaDifferenceHRF(convolution="direct", **kws)
+            hrf_fft = glm.GammaDifferenceHRF(convolution="fft", **kws)
+            hrf_auto = glm.GammaDifferenceHRF(**kws)
+            conv_direct = hrf_direct.convolve_matrix(data)
+            conv_fft = hrf_fft.convolve_matrix(data)
+            conv_auto = hrf_auto.convolve_matrix(data)
+            npt.assert_allclose(conv_direct, conv_fft, atol=1e-12)
+            npt.assert_allclose(conv_direct, conv_auto, atol=1e-12)
+
+            conv_direct = hrf_direct.convolve(data[:, 0])
+            conv_fft = hrf_fft.convolve(data[:, 0])
+            npt.assert_allclose(conv_direct, conv_fft, atol=1e-12)
+
+
+@nt.raises(ValueError)
+def test_hrf_convolution_method_error():
+    """Test that we are strict about the convolution method."""
+    glm.GammaDifferenceHRF(convolution="fast")
+
+
 def test_identity_hrf():
     """Test the identity HRF model."""
     data = np.random.randn(20)
@@ -127,6 +177,33 @@ def test_identity_hrf():
     npt.assert_array_equal(out.donna.values, data)
 
 
+def test_identity_hrf_matrix():
+    """Test the identity HRF model on a matrix."""
+    data = np.random.randn(20, 2)
+    frametimes = np.arange(20)
+    names = ["josh", "donna"]
+
+    hrf = glm.IdentityHRF()
+    out = hrf.convolve_matrix(data, frametimes, names)
+    nt.assert_equal(out.columns.tolist(), names)
+    npt.assert_array_equal(out.index.values, frametimes)
+    npt.assert_array_equal(out.values, data)
+
+
+def test_design_matrix_convolve_only_hrf():
+    """Test a design with an HRF model that only defines convolve."""
+    class ConvolveOnlyHRF(object):
+        def convolve(self, data, frametimes, name):
+            return pd.DataFrame({name: data}, index=frametimes)
+
+    design = pd.DataFrame(dict(condition=["one", "two"],
+                               onset=[5, 20]))
+    X_a = glm.DesignMatrix(design, glm.IdentityHRF(), 30)
+    X_b = glm.DesignMatrix(design, ConvolveOnlyHRF(), 30)
+    npt.assert_array_equal(X_a.design_matrix.values,
+                           X_b.design_matrix.values)
+
+
 def test_design_matrix_size():
     """Test the size of the resulting matrix with various options."""
     hrf = glm.GammaDifferenceHRF()
@@ -186,6 +263,23 @@ def test_design_matrix_conditions():
     nt.assert_equal(x_max, [5, 10])
 
 
+def test_design_matrix_coincident_conditions():
+    """Test condition vectors when events share onsets and durations."""
+    hrf = glm.IdentityHRF()
+    design = pd.DataFrame(dict(condition=["one", "two", "one", "three"],
+                               onset=[2, 2, 6, 9],
+                               duration=[0, 3, 2, 0],
+                               value=[1, 2, 3, 4]))
+    X = glm.DesignMatrix(design, hrf, 12, tr=1, oversampling=1,
+                         hpf_cutoff=None, condition_names=["two", "one"])
+    hires = X._hires_conditions
+    nt.assert_equal(hires.columns.tolist(), ["two", "one"])
+    npt.assert_array_equal(hires.two.values[:12],
+                           [0, 0, 2, 2, 2, 0, 0, 0, 0, 0, 0, 0])
+    npt.assert_array_equal(hires.one.values[:12],
+                           [0, 0, 1, 0, 0, 0, 3, 3, 0, 0, 0, 0])
+
+
 def test_design_matrix_condition_names():
     """Test that we can specify condition names."""
     hrf = glm.IdentityHRF()
@@ -305,6 +399,39 @@ def test_design_matrix_confound_pca():
     nt.assert_equal(n_confounds, good_dims)
 
 
+def test_design_matrix_from_many():
+    """Test building a batch of design matrices."""
+    hrf = glm.GammaDifferenceHRF(temporal_deriv=True)
+    designs = [pd.DataFrame(dict(condition=["one", "two", "one"],
+                                 onset=np.sort(np.random.rand(3) * 30)))
+               for i in range(5)]
+    ntps = [20, 20, 25, 30, 20]
+    confounds = np.random.randn(20, 2)
+
+    wanted = [glm.DesignMatrix(d, hrf, 20, confounds=confounds)
+              for d in designs]
+    for n_jobs in [1, 2]:
+        got = glm.DesignMatrix.from_many(designs, hrf, 20, n_jobs=n_jobs,
+                                         confounds=confounds)
+        nt.assert_equal(len(got), len(designs))
+        for X_wanted, X_got in zip(wanted, got):
+            npt.assert_array_equal(X_wanted.design_matrix,
+                                   X_got.design_matrix)
+            nt.assert_equal(X_wanted.design_matrix.columns.tolist(),
+                            X_got.design_matrix.columns.tolist())
+
+    got = glm.DesignMatrix.from_many(designs, hrf, ntps, n_jobs=2)
+    nt.assert_equal([X.shape[0] for X in got], ntps)
+
+
+@nt.raises(ValueError)
+def test_design_matrix_from_many_ntp_error():
+    """Test that ntp must match the number of designs."""
+    hrf = glm.GammaDifferenceHRF()
+    designs = [pd.DataFrame(dict(condition=["one"], onset=[5]))] * 3
+    glm.DesignMatrix.from_many(designs, hrf, [20, 20])
+
+
 def test_highpass_matrix_shape():
     """Test the filter matrix is the right shape."""
     for n_tp in 10, 100:
@@ -318,6 +445,35 @@ def test_filter_matrix_diagonal():
     npt.assert_array_equal(F.argmax(axis=1).squeeze(), np.arange(10))
 
 
+def _dense_highpass_matrix(ntp, cutoff, tr=2):
+    """Reference implementation of the filter with a full inverse per row."""
+    cutoff = cutoff / tr
+    sig2n = np.square(cutoff / np.sqrt(2))
+
+    kernel = np.exp(-np.square(np.arange(ntp)) / (2 * sig2n))
+    kernel = 1 / np.sqrt(2 * np.pi * sig2n) * kernel
+
+    K = linalg.toeplitz(kernel)
+    K = np.dot(np.diag(1 / K.sum(axis=1)), K)
+
+    H = np.zeros((ntp, ntp))
+    X = np.column_stack((np.ones(ntp), np.arange(ntp)))
+    for k in range(ntp):
+        W = np.diag(K[k])
+        hat = np.dot(np.dot(X, np.linalg.pinv(np.dot(W, X))), W)
+        H[k] = hat[k]
+    return np.eye(ntp) - H
+
+
+def test_highpass_matrix_dense_equivalence():
+    """Test the closed-form filter against the full running line fit."""
+    for ntp, cutoff, tr in [(1, 128, 2), (2, 10, 2), (10, 3, 2),
+                            (100, 50, 2), (150, 128, 2), (200, 30, .72)]:
+        F = glm.fsl_highpass_matrix(ntp, cutoff, tr)
+        F_dense = _dense_highpass_matrix(ntp, cutoff, tr)
+        npt.assert_allclose(F, F_dense, atol=1e-10)
+
+
 def test_filtered_data_shape():
     """Test that filtering data returns same shape."""
     data = np.random.randn(100)
@@ -366,3 +522,302 @@ def test_filter_copy():
     assert(not (a == a_copy).all())
     a_nocopy = glm.fsl_highpass_filter(a, 100, copy=False)
     npt.assert_array_equal(a, a_nocopy)
+
+
+def test_filter_matrix_free():
+    """Test that the matrix-free filter matches the filter matrix."""
+    a = np.random.randn(100, 25)
+    a_matrix = glm.fsl_highpass_filter(a, 50)
+    for chunk_size in [1, 7, 25, 100]:
+        a_free = glm.fsl_highpass_filter(a, 50, matrix_free=True,
+                                         chunk_size=chunk_size)
+        npt.assert_array_almost_equal(a_matrix, a_free)
+
+    b = np.random.randn(100)
+    b_matrix = glm.fsl_highpass_filter(b, 30)
+    b_free = glm.fsl_highpass_filter(b, 30, matrix_free=True)
+    nt.assert_equal(b.shape, b_free.shape)
+    npt.assert_array_almost_equal(b_matrix, b_free)
+
+
+def test_filter_hat_blocks():
+    """Test that the hat matrix blocks tile the rows in bounded memory."""
+    for ntp, cutoff in [(300, 1e6), (300, 20), (7, 128)]:
+        F = glm.fsl_highpass_matrix(ntp, cutoff)
+        blocks = list(glm._highpass_hat_blocks(ntp, cutoff, 2,
+                                               max_elements=2 ** 12))
+        rows = np.concatenate([np.arange(ntp)[r] for r, _, _ in blocks])
+        npt.assert_array_equal(rows, np.arange(ntp))
+        for r, c, H in blocks:
+            if ntp > 7:
+                nt.assert_less(H.size, ntp ** 2 // 4)
+            F_block = np.eye(ntp)[r] - np.pad(H, ((0, 0), (c.start,
+                                                           ntp - c.stop)),
+                                              "constant")
+            npt.assert_array_almost_equal(F[r], F_block)
+
+
+def test_filter_matrix_free_memmap():
+    """Test that we can filter a memory-mapped array in place."""
+    a = np.random.randn(60, 10)
+    a_filt = glm.fsl_highpass_filter(a, 40)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tmpdir, "data.dat")
+        mm = np.memmap(fname, np.float64, "w+", shape=a.shape)
+        mm[:] = a
+        glm.fsl_highpass_filter(mm, 40, copy=False,
+                                matrix_free=True, chunk_size=3)
+        mm.flush()
+        del mm
+
+        mm = np.memmap(fname, np.float64, "r", shape=a.shape)
+        npt.assert_array_almost_equal(a_filt, mm)
+        del mm
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_filter_cache():
+    """Test the memory cache of filter matrices."""
+    cache = glm.FilterMatrixCache()
+    F1 = cache.get(50, 30, 2)
+    F2 = cache.get(50, 30, 2)
+    nt.assert_true(F1 is F2)
+    npt.assert_array_equal(F1, glm.fsl_highpass_matrix(50, 30, 2))
+    nt.assert_false(F1.flags.writeable)
+
+    cache.get(50, 30, 1)
+    info = cache.info()
+    nt.assert_equal(info["hits"], 1)
+    nt.assert_equal(info["misses"], 2)
+    nt.assert_equal(info["size"], 2)
+    nt.assert_equal(info["nbytes"], 2 * F1.nbytes)
+
+    cache.clear()
+    nt.assert_equal(cache.info()["size"], 0)
+    nt.assert_equal(cache.info()["misses"], 0)
+
+
+def test_filter_cache_budget():
+    """Test that the cache evicts least recently used matrices."""
+    nbytes = glm.fsl_highpass_matrix(20, 30).nbytes
+    cache = glm.FilterMatrixCache(max_bytes=2 * nbytes)
+    cache.get(20, 30)
+    cache.get(20, 40)
+    cache.get(20, 30)
+    cache.get(20, 50)
+    nt.assert_equal(cache.info()["size"], 2)
+    nt.assert_equal(cache.info()["nbytes"], 2 * nbytes)
+
+    cache.get(20, 30)
+    nt.assert_equal(cache.info()["hits"], 2)
+    cache.get(20, 40)
+    nt.assert_equal(cache.info()["misses"], 4)
+
+    cache = glm.FilterMatrixCache(max_bytes=0)
+    cache.get(20, 30)
+    cache.get(20, 30)
+    nt.assert_equal(cache.info()["misses"], 2)
+
+
+def test_filter_cache_dir():
+    """Test the on-disk cache of filter matrices."""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cache = glm.FilterMatrixCache(cache_dir=tmpdir)
+        F1 = cache.get(40, 30, 2)
+        nt.assert_equal(len(os.listdir(tmpdir)), 1)
+
+        cache = glm.FilterMatrixCache(cache_dir=tmpdir)
+        F2 = cache.get(40, 30, 2)
+        nt.assert_equal(cache.info()["disk_hits"], 1)
+        nt.assert_equal(cache.info()["misses"], 0)
+        nt.assert_true(isinstance(F2, np.memmap))
+        npt.assert_array_equal(F1, F2)
+        del F2
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_filter_cache_dir_threads():
+    """Test that threads can miss the same key in the on-disk cache."""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        errors = []
+
+        def get(cache):
+            try:
+                cache.get(400, 128, 2)
+            except Exception as err:
+                errors.append(err)
+
+        for trial in range(5):
+            cache = glm.FilterMatrixCache(cache_dir=tmpdir)
+            threads = [threading.Thread(target=get, args=(cache,))
+                       for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            for fname in os.listdir(tmpdir):
+                os.remove(os.path.join(tmpdir, fname))
+
+        nt.assert_equal(errors, [])
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_glm_fit():
+    """Test the GLM against a regression with an explicit constant."""
+    X = np.random.randn(40, 3)
+    X -= X.mean(axis=0)
+    data = np.dot(X, np.random.randn(3, 25)) + np.random.randn(40, 25) + 3
+
+    model = glm.GLM(X, chunk_size=7).fit(data)
+    nt.assert_equal(model.betas_.shape, (3, 25))
+    nt.assert_equal(model.sigma2_.shape, (25,))
+    nt.assert_equal(model.dof_, 36)
+
+    X_const = np.column_stack((X, np.ones(40)))
+    betas, ss_resid, _, _ = np.linalg.lstsq(X_const, data)
+    npt.assert_array_almost_equal(model.betas_, betas[:3])
+    npt.assert_array_almost_equal(model.sigma2_, ss_resid / 36)
+
+    model_one = glm.GLM(X).fit(data[:, 0])
+    npt.assert_array_almost_equal(model_one.betas_[:, 0], betas[:3, 0])
+
+
+def test_glm_uncentered_design():
+    """Test that an uncentered design is fit with an implicit constant."""
+    rs = np.random.RandomState(0)
+    X = rs.randn(50, 2) + 2
+    data = np.dot(X, [[1], [2]]) + rs.randn(50, 1) + 5
+
+    X_const = np.column_stack((X, np.ones(50)))
+    betas, ss_resid, _, _ = np.linalg.lstsq(X_const, data, rcond=-1)
+    for prewhiten in [False, True]:
+        model = glm.GLM(X, prewhiten=prewhiten).fit(data)
+        nt.assert_equal(model.dof_, 47)
+        if not prewhiten:
+            npt.assert_array_almost_equal(model.betas_, betas[:2])
+            npt.assert_array_almost_equal(model.sigma2_, ss_resid / 47)
+
+        model_c = glm.GLM(X - X.mean(axis=0), prewhiten=prewhiten).fit(data)
+        npt.assert_array_almost_equal(model.betas_, model_c.betas_)
+        npt.assert_array_almost_equal(model.sigma2_, model_c.sigma2_)
+
+
+def test_glm_contrast():
+    """Test GLM contrast statistics."""
+    X = np.random.randn(40, 2)
+    X -= X.mean(axis=0)
+    data = np.dot(X, np.random.randn(2, 10)) + np.random.randn(40, 10)
+    model = glm.GLM(X).fit(data)
+    t, z = model.contrast([[1, 0], [1, -1]])
+    nt.assert_equal(t.shape, (2, 10))
+
+    X_const = np.column_stack((X, np.ones(40)))
+    XtX_inv = np.linalg.inv(np.dot(X_const.T, X_const))
+    betas, ss_resid, _, _ = np.linalg.lstsq(X_const, data)
+    se = np.sqrt(XtX_inv[0, 0] * ss_resid / 37)
+    npt.assert_array_almost_equal(t[0], betas[0] / se)
+
+    p_t = stats.t.sf(t, 37)
+    p_z = stats.norm.sf(z)
+    npt.assert_array_almost_equal(p_t, p_z)
+
+
+def test_glm_design_matrix():
+    """Test fitting a GLM with a DesignMatrix and named contrasts."""
+    hrf = glm.GammaDifferenceHRF()
+    design = pd.DataFrame(dict(condition=["one", "two"] * 3,
+                               onset=[5, 15, 30, 45, 60, 75]))
+    X = glm.DesignMatrix(design, hrf, 50)
+    data = np.random.randn(50, 20)
+    model = glm.GLM(X).fit(data)
+
+    contrasts = [("one-two", ["one", "two"], [1, -1])]
+    t_named, _ = model.contrast(contrasts)
+    t_vector, _ = model.contrast([X.contrast_vector(["one", "two"],
+                                                    [1, -1])])
+    npt.assert_array_equal(t_named, t_vector)
+
+
+def test_glm_memmap():
+    """Test fitting a GLM to memory-mapped data."""
+    X = np.random.randn(30, 2)
+    data = np.random.randn(30, 12)
+    model = glm.GLM(X).fit(data)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tmpdir, "data.dat")
+        mm = np.memmap(fname, np.float64, "w+", shape=data.shape)
+        mm[:] = data
+        mm.flush()
+        del mm
+
+        mm = np.memmap(fname, np.float64, "r", shape=data.shape)
+        model_mm = glm.GLM(X, chunk_size=5).fit(mm)
+        npt.assert_array_almost_equal(model.betas_, model_mm.betas_)
+        npt.assert_array_almost_equal(model.sigma2_, model_mm.sigma2_)
+        del mm
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _ar1_noise(ntp, n_cols, rho):
+    """Simulate AR(1) noise in each column."""
+    noise = np.random.randn(ntp, n_cols)
+    for t in range(1, ntp):
+        noise[t] += rho * noise[t - 1]
+    return noise
+
+
+def test_glm_prewhiten():
+    """Test the binned AR(1) prewhitened GLM against per-column fits."""
+    X = np.random.randn(100, 2)
+    X -= X.mean(axis=0)
+    data = np.dot(X, [[1, 2] * 10, [0, 1] * 10]) + _ar1_noise(100, 20, .4)
+
+    model = glm.GLM(X, chunk_size=6, prewhiten=True).fit(data)
+    nt.assert_equal(model.betas_.shape, (2, 20))
+    nt.assert_less(np.abs(model.ar1_.mean() - .4), .15)
+    npt.assert_array_almost_equal(model.ar1_, np.round(model.ar1_, 2))
+
+    t, _ = model.contrast([[1, -1]])
+    for i in range(20):
+        rho = model.ar1_[i]
+        W = np.eye(100) - rho * np.eye(100, k=-1)
+        W[0, 0] = np.sqrt(1 - rho ** 2)
+        X_w = np.dot(W, np.column_stack((X, np.ones(100))))
+        y_w = np.dot(W, data[:, i] - data[:, i].mean())
+        betas, ss_resid, _, _ = np.linalg.lstsq(X_w, y_w)
+        npt.assert_array_almost_equal(model.betas_[:, i], betas[:2])
+        npt.assert_almost_equal(model.sigma2_[i], ss_resid[0] / 97)
+
+        c = np.array([1, -1, 0])
+        se = np.sqrt(np.dot(c, np.dot(np.linalg.inv(np.dot(X_w.T, X_w)), c))
+                     * ss_resid[0] / 97)
+        npt.assert_almost_equal(t[0, i], np.dot(c, betas) / se)
+
+
+def test_glm_prewhiten_bins():
+    """Test that the AR(1) coefficients are binned at the given precision."""
+    X = np.random.randn(80, 2)
+    data = _ar1_noise(80, 200, .2)
+    model = glm.GLM(X, prewhiten=True, ar_precision=.1).fit(data)
+    n_bins = len(np.unique(model.ar1_))
+    nt.assert_equal(len(model._XtX_inv), n_bins + 1)
+    npt.assert_array_almost_equal(model.ar1_ * 10, np.round(model.ar1_ * 10))
+
+    model_ols = glm.GLM(X).fit(data)
+    nt.assert_equal(model_ols.ar1_, None)
+
+
+@nt.raises(ValueError)
+def test_glm_length_error():
+    """Test that data and design must have the same length."""
+    glm.GLM(np.random.randn(20, 2)).fit(np.random.randn(30, 4))
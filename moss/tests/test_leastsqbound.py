@@ -0,0 +1,153 @@
+import numpy as np
+import numpy.testing as npt
+import nose.tools
+
+from moss import leastsqbound as lsb
+
+
+x = np.linspace(0, 5, 40)
+y = 2.5 * np.exp(-1.3 * x) + .5
+
+
+def _residuals(p):
+    a, b, c = p
+    return y - (a * np.exp(-b * x) + c)
+
+
+t = np.linspace(0, 6, 60)
+wave = np.sin(3.7 * t)
+
+
+def _wave_residuals(p):
+    return wave - np.sin(p[0] * t)
+
+
+def _jacobian(p):
+    a, b, c = p
+    return -np.column_stack([np.exp(-b * x),
+                             -a * x * np.exp(-b * x),
+                             np.ones_like(x)])
+
+
+def test_parameter_transforms():
+    """Test the internal/external transforms on batches of parameters."""
+    bounds = [(None, None), (0, None), (None, 3), (-1, 2)]
+    i2e = lsb._internal2external_func(bounds)
+    e2i = lsb._external2internal_func(bounds)
+    grad = lsb._internal2external_grad_func(bounds)
+
+    xi = np.random.RandomState(0).uniform(-1.5, 1.5, (10, 4))
+    xe = i2e(xi)
+    assert (xe[:, 1] >= 0).all()
+    assert (xe[:, 2] <= 3).all()
+    assert ((xe[:, 3] >= -1) & (xe[:, 3] <= 2)).all()
+
+    # One-sided transforms only identify the magnitude of the internal value
+    xi_back = xi.copy()
+    xi_back[:, 1:3] = np.abs(xi_back[:, 1:3])
+    npt.assert_allclose(e2i(xe), xi_back)
+    for xi_row, xe_row in zip(xi, xe):
+        npt.assert_array_equal(i2e(xi_row), xe_row)
+
+    deriv = (i2e(xi + 1e-6) - i2e(xi - 1e-6)) / 2e-6
+    npt.assert_allclose(grad(xi), deriv, rtol=1e-6)
+
+
+def test_leastsqbound_unbounded():
+    """Test that we recover the parameters without bounds."""
+    p, _ = lsb.leastsqbound(_residuals, [1, 1, 0])
+    npt.assert_allclose(p, [2.5, 1.3, .5], rtol=1e-6)
+
+
+def test_leastsqbound_dfun():
+    """Test that an analytic Jacobian works with every kind of bound."""
+    bounds_list = [[(None, None)] * 3,
+                   [(0, None), (0, None), (None, None)],
+                   [(None, 10), (None, 5), (None, 2)],
+                   [(0, 10), (0, 5), (-1, 2)]]
+    for bounds in bounds_list:
+        p_num, _ = lsb.leastsqbound(_residuals, [1, 1, 0], bounds=bounds)
+        p_jac, _ = lsb.leastsqbound(_residuals, [1, 1, 0], bounds=bounds,
+                                    Dfun=_jacobian)
+        npt.assert_allclose(p_jac, [2.5, 1.3, .5], rtol=1e-6)
+        npt.assert_allclose(p_jac, p_num, rtol=1e-6)
+
+    # Column-ordered derivatives should give the same answer
+    p_col, _ = lsb.leastsqbound(_residuals, [1, 1, 0], bounds=bounds,
+                                Dfun=lambda p: _jacobian(p).T, col_deriv=1)
+    npt.assert_allclose(p_col, p_jac)
+
+
+def test_leastsqbound_active_bound():
+    """Test that the solution respects a bound that excludes the optimum."""
+    bounds = [(None, None), (None, 1), (None, None)]
+    for Dfun in [None, _jacobian]:
+        p, _ = lsb.leastsqbound(_residuals, [1, .5, 0], bounds=bounds,
+                                Dfun=Dfun)
+        nose.tools.assert_less_equal(p[1], 1)
+        npt.assert_allclose(p[1], 1, atol=1e-4)
+
+
+def test_leastsqbound_multistart():
+    """Test that multiple starts escape a local minimum."""
+    bounds = [(.1, 10)]
+    p_single, _ = lsb.leastsqbound(_wave_residuals, [1], bounds=bounds)
+    nose.tools.assert_greater(abs(p_single[0] - 3.7), .1)
+
+    samplings = ["lhs"]
+    try:
+        from scipy.stats import qmc  # noqa
+        samplings.append("sobol")
+    except ImportError:
+        pass
+    for sampling in samplings:
+        p, ps, costs = lsb.leastsqbound_multistart(_wave_residuals, bounds,
+                                                   16, sampling=sampling,
+                                                   random_seed=0)
+        npt.assert_allclose(p, [3.7], rtol=1e-6)
+        nose.tools.assert_equal(ps.shape, (16, 1))
+        nose.tools.assert_equal(costs.min(), np.sum(_wave_residuals(p) ** 2))
+
+    # Results should not depend on the number of workers
+    _, ps_a, _ = lsb.leastsqbound_multistart(_wave_residuals, bounds, 16,
+                                             random_seed=0)
+    _, ps_b, _ = lsb.leastsqbound_multistart(_wave_residuals, bounds, 16,
+                                             random_seed=0, n_jobs=2)
+    npt.assert_array_equal(ps_a, ps_b)
+
+
+def test_leastsqbound_multistart_target():
+    """Test stopping once a target cost is reached."""
+    bounds = [(None, None), (0, None), (None, None)]
+    start_bounds = [(0, 5), (0, 5), (-1, 1)]
+    for n_jobs in [1, 2]:
+        p, ps, costs = lsb.leastsqbound_multistart(_residuals, bounds, 20,
+                                                   start_bounds=start_bounds,
+                                                   random_seed=0,
+                                                   target_cost=1e-10,
+                                                   n_jobs=n_jobs)
+        nose.tools.assert_less(len(ps), 20)
+        nose.tools.assert_less_equal(costs[-1], 1e-10)
+        npt.assert_allclose(p, [2.5, 1.3, .5], rtol=1e-6)
+
+    # Serial runs should not fit the starting points after the target
+    calls = []
+
+    def counted(p):
+        calls.append(p)
+        return _residuals(p)
+
+    kws = dict(start_bounds=start_bounds, random_seed=0)
+    lsb.leastsqbound_multistart(counted, bounds, 20, **kws)
+    n_calls_all = len(calls)
+    del calls[:]
+    _, ps, _ = lsb.leastsqbound_multistart(counted, bounds, 20,
+                                           target_cost=1e-10, **kws)
+    nose.tools.assert_less(len(ps), 20)
+    nose.tools.assert_less(len(calls), n_calls_all)
+
+
+@nose.tools.raises(ValueError)
+def test_leastsqbound_multistart_bounds_error():
+    """Test that starting points need finite bounds."""
+    lsb.leastsqbound_multistart(_residuals, [(None, None)] * 3)
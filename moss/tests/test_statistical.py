@@ -3,6 +3,7 @@ import scipy as sp
 from scipy import stats as spstats
 import pandas as pd
 from sklearn.naive_bayes import GaussianNB
+from sklearn.linear_model import RidgeClassifier
 
 from numpy.testing import assert_array_equal, assert_array_almost_equal
 import numpy.testing as npt
@@ -74,6 +75,99 @@ def test_bootstrap_axis():
     assert_equal(out_axis.shape, (n_boot, 20))
 
 
+def test_bootstrap_blocks():
+    """Test that block size and vectorization don't change the result."""
+    x = np.random.randn(30, 3)
+    outs = []
+    for block_size in [1, 7, 100]:
+        for vectorized in [True, False]:
+            np.random.seed(0)
+            outs.append(stat.bootstrap(x, n_boot=100, axis=0,
+                                       func=np.median,
+                                       block_size=block_size,
+                                       vectorized=vectorized))
+    for out in outs[1:]:
+        assert_array_almost_equal(outs[0], out)
+
+    np.random.seed(0)
+    out_none = stat.bootstrap(x, n_boot=100, block_size=7)
+    np.random.seed(0)
+    out_loop = stat.bootstrap(x, n_boot=100, vectorized=False)
+    assert_equal(out_none.shape, (100,))
+    assert_array_almost_equal(out_none, out_loop)
+
+
+def test_bootstrap_summarize():
+    """Test streaming bootstrap summaries against the full distribution."""
+    x = np.random.randn(40, 5)
+    for which, block_size in [(95, 13), (68, 1000), (99, 1)]:
+        np.random.seed(0)
+        dist = stat.bootstrap(x, n_boot=500, axis=0, block_size=block_size)
+        np.random.seed(0)
+        se, ci = stat.bootstrap(x, n_boot=500, axis=0, summarize=True,
+                                which=which, block_size=block_size)
+        assert_array_almost_equal(se, dist.std(axis=0))
+        assert_array_almost_equal(ci, stat.ci(dist, which, axis=0))
+
+
+def test_bootstrap_seed():
+    """Test that a seeded bootstrap is stable."""
+    x = np.random.randn(30)
+    out_a = stat.bootstrap(x, n_boot=100, random_seed=0)
+    out_b = stat.bootstrap(x, n_boot=100, random_seed=0)
+    out_c = stat.bootstrap(x, n_boot=100, random_seed=1)
+    assert_array_equal(out_a, out_b)
+    assert(not np.array_equal(out_a, out_c))
+
+
+def test_bootstrap_n_jobs():
+    """Test that results do not depend on the number of workers."""
+    x = np.random.randn(30, 4)
+    kws = dict(n_boot=200, axis=0, block_size=16, random_seed=0)
+    out_serial = stat.bootstrap(x, **kws)
+    for backend in ["thread", "process"]:
+        for n_jobs in [2, 3]:
+            out = stat.bootstrap(x, n_jobs=n_jobs, backend=backend, **kws)
+            assert_array_equal(out_serial, out)
+
+    se, ci = stat.bootstrap(x, n_jobs=3, summarize=True, **kws)
+    assert_array_almost_equal(se, out_serial.std(axis=0))
+    assert_array_almost_equal(ci, stat.ci(out_serial, axis=0))
+
+
+def test_bootstrap_executor_workers():
+    """Test that an executor gets a task per worker."""
+    try:
+        from concurrent.futures import ThreadPoolExecutor
+    except ImportError:
+        raise nose.SkipTest("concurrent.futures is not available")
+
+    class CountingExecutor(ThreadPoolExecutor):
+        """Thread pool that counts the tasks submitted to it."""
+        n_tasks = 0
+
+        def submit(self, *args, **kwargs):
+            self.n_tasks += 1
+            return super(CountingExecutor, self).submit(*args, **kwargs)
+
+    x = np.random.randn(30, 4)
+    kws = dict(n_boot=200, axis=0, block_size=16, random_seed=0)
+    out_serial = stat.bootstrap(x, **kws)
+    executor = CountingExecutor(max_workers=3)
+    try:
+        out = stat.bootstrap(x, backend=executor, **kws)
+    finally:
+        executor.shutdown()
+    assert_array_equal(out_serial, out)
+    assert_equal(executor.n_tasks, 3)
+
+
+@raises(ValueError)
+def test_bootstrap_backend_error():
+    """Test that we are strict about the worker pool backend."""
+    stat.bootstrap(a_norm, n_boot=10, n_jobs=2, backend="cluster")
+
+
 def test_smooth_bootstrap():
     """Test smooth bootstrap."""
     x = np.random.randn(15)
@@ -85,6 +179,29 @@ def test_smooth_bootstrap():
     assert(not np.median(out_smooth) in x)
 
 
+def test_smooth_bootstrap_multicolumn():
+    """Test smooth bootstrap with multi-column inputs."""
+    x = np.random.randn(40, 3)
+    n_boot = 200
+    out = stat.bootstrap(x, n_boot=n_boot, axis=0, smooth=True,
+                         func=np.median, random_seed=0)
+    assert_equal(out.shape, (n_boot, 3))
+    assert(not np.in1d(out, x).any())
+
+    out_seed = stat.bootstrap(x, n_boot=n_boot, axis=0, smooth=True,
+                              func=np.median, random_seed=0)
+    assert_array_equal(out, out_seed)
+
+    # The noise should inflate the sample variance by the KDE bandwidth
+    var_plain = stat.bootstrap(x, n_boot=n_boot, axis=0, func=np.var)
+    var_smooth = stat.bootstrap(x, n_boot=n_boot, axis=0, func=np.var,
+                                smooth=True)
+    factor = 40 ** (-2. / 7)
+    assert_array_almost_equal(var_smooth.mean(axis=0) /
+                              var_plain.mean(axis=0),
+                              np.ones(3) + factor, 1)
+
+
 def test_bootstrap_ols():
     """Test bootstrap of OLS model fit."""
     ols_fit = lambda X, y: np.dot(np.dot(np.linalg.inv(
@@ -114,6 +231,13 @@ def test_bootstrap_arglength():
     stat.bootstrap(range(5), range(10))
 
 
+def test_bootstrap_n_boot_error():
+    """Test that we need at least one bootstrap iteration."""
+    for summarize in [False, True]:
+        nose.tools.assert_raises(ValueError, stat.bootstrap, a_norm,
+                                 n_boot=0, summarize=summarize)
+
+
 @raises(TypeError)
 def test_bootstrap_noncallable():
     """Test that we get a TypeError with noncallable statfunc."""
@@ -249,6 +373,55 @@ def test_randomize_onesample_seed():
     assert_array_equal(samples_a, samples_b)
 
 
+def test_randomize_onesample_n_jobs():
+    """Test that results do not depend on the number of workers."""
+    a = np.random.normal(0, 1, (20, 60000))
+    for corrected in [True, False]:
+        t_a, p_a, dist_a = stat.randomize_onesample(a, 50,
+                                                    corrected=corrected,
+                                                    random_seed=0,
+                                                    return_dist=True)
+        for backend in ["process", "thread"]:
+            t_b, p_b, dist_b = stat.randomize_onesample(a, 50,
+                                                        corrected=corrected,
+                                                        random_seed=0,
+                                                        return_dist=True,
+                                                        n_jobs=2,
+                                                        backend=backend)
+            assert_array_equal(t_a, t_b)
+            assert_array_equal(p_a, p_b)
+            assert_array_equal(dist_a, dist_b)
+
+
+def test_permutation_pvals():
+    """Test p values against explicit empirical CDF calculations."""
+    rs = np.random.RandomState(0)
+    null = rs.normal(0, 1, (4, 500))
+    obs = np.array([-2, -.5, .5, 2])
+
+    cdf = np.array([(n <= o).mean() for n, o in zip(null, obs)])
+    abs_cdf = np.array([(n <= abs(o)).mean() for n, o in zip(null, obs)])
+    assert_array_equal(stat.permutation_pvals(obs, null), 1 - cdf)
+    assert_array_equal(stat.permutation_pvals(obs, null, "lower"), cdf)
+    assert_array_equal(stat.permutation_pvals(obs, null, "both"),
+                       2 * (1 - abs_cdf))
+
+    shared = null[0]
+    cdf = np.array([(shared <= o).mean() for o in obs])
+    assert_array_equal(stat.permutation_pvals(obs, shared), 1 - cdf)
+    assert_array_equal(stat.permutation_pvals(obs, shared, "lower"), cdf)
+
+    p = stat.permutation_pvals(1, shared)
+    assert_equal(np.shape(p), ())
+    assert_equal(p, (shared > 1).mean())
+
+
+@raises(ValueError)
+def test_permutation_pvals_tail_error():
+    """Test that an unknown tail raises a ValueError."""
+    stat.permutation_pvals(0, np.zeros(10), "sideways")
+
+
 def test_randomize_onesample_multitest():
     """Test that randomizing over multiple tests works."""
     a = np.random.normal(0, 1, (20, 5))
@@ -269,6 +442,31 @@ def test_randomize_onesample_correction():
     npt.assert_array_less(p_un, p_corr)
 
 
+def test_randomize_onesample_pvals():
+    """Test that p values come from the returned null distributions."""
+    a = np.random.normal(.3, 1, (20, 6))
+    t, p, dist = stat.randomize_onesample(a, 1000, corrected=False,
+                                          random_seed=0, return_dist=True)
+    for t_i, p_i, dist_i in zip(t, p, dist):
+        assert_almost_equal(p_i, (dist_i > t_i).mean())
+
+    t, p, dist = stat.randomize_onesample(a, 1000, corrected=True,
+                                          random_seed=0, return_dist=True)
+    max_dist = dist.max(axis=0)
+    for t_i, p_i in zip(t, p):
+        assert_almost_equal(p_i, (max_dist > t_i).mean())
+
+
+def test_randomize_onesample_flip_stats():
+    """Test the closed-form sign-flip t statistics."""
+    a = np.random.normal(0, 1, (15, 4))
+    flipper = (np.random.rand(30, 15) > .5) * 2 - 1
+    flipped = a * flipper[:, :, None]
+    t_wanted = flipped.mean(axis=1) / (flipped.std(axis=1) / np.sqrt(14))
+    t_got = stat._sign_flip_t(a, flipper)
+    assert_array_almost_equal(t_wanted, t_got)
+
+
 def test_randomize_onesample_h0():
     """Test that we can supply a null hypothesis for the group mean."""
     a = np.random.normal(4, 1, 100)
@@ -359,6 +557,45 @@ def test_randomise_corrmat_seed():
     assert_array_equal(dist1, dist2)
 
 
+def test_randomize_corrmat_null_pvals():
+    """Test that p values follow from the returned null distribution."""
+    rs = np.random.RandomState(0)
+    a = rs.randn(6, 25)
+    a[1] += a[0]
+    obs = np.corrcoef(a)
+    triu = np.triu_indices(6, 1)
+    for tail in ["both", "upper", "lower"]:
+        p_mat, dist = stat.randomize_corrmat(a, tail, False, 200,
+                                             random_seed=0, return_dist=True)
+        p_null = stat.permutation_pvals(obs[triu], dist[triu], tail)
+        assert_array_almost_equal(p_mat[triu], p_null)
+        assert_array_equal(p_mat, p_mat.T)
+
+    p_mat, dist = stat.randomize_corrmat(a, "both", True, 200,
+                                         random_seed=0, return_dist=True)
+    max_dist = np.abs(dist[triu]).max(axis=0)
+    p_null = stat.permutation_pvals(np.abs(obs[triu]), max_dist)
+    assert_array_almost_equal(p_mat[triu], p_null)
+
+
+def test_randomize_corrmat_n_jobs():
+    """Test that results do not depend on the number of workers."""
+    a = np.random.randn(150, 30)
+    for tail in ["both", "upper"]:
+        for corrected in [True, False]:
+            p_a, dist_a = stat.randomize_corrmat(a, tail, corrected, 300,
+                                                 random_seed=0,
+                                                 return_dist=True)
+            for backend in ["process", "thread"]:
+                p_b, dist_b = stat.randomize_corrmat(a, tail, corrected, 300,
+                                                     random_seed=0,
+                                                     return_dist=True,
+                                                     n_jobs=2,
+                                                     backend=backend)
+                assert_array_equal(p_a, p_b)
+                assert_array_equal(dist_a, dist_b)
+
+
 @raises(ValueError)
 def test_randomize_corrmat_tail_error():
     """Test that we are strict about tail paramete."""
@@ -366,6 +603,24 @@ def test_randomize_corrmat_tail_error():
     stat.randomize_corrmat(a, "hello")
 
 
+def test_permute_within_runs():
+    """Test that permutations only exchange samples within runs."""
+    runs = np.array(["b", "a", "b", "c", "a", "a", "c", "b", "c"])
+    perms = stat.permute_within_runs(runs, 200, random_seed=0)
+    assert_equal(perms.shape, (200, 9))
+    for perm in perms:
+        assert_array_equal(np.sort(perm), np.arange(9))
+        assert_array_equal(runs[perm], runs)
+
+    # Every sample should visit every position in its run
+    for i, run in enumerate(runs):
+        assert_array_equal(np.unique(perms[:, i]),
+                           np.flatnonzero(runs == run))
+
+    perms_b = stat.permute_within_runs(runs, 200, random_seed=0)
+    assert_array_equal(perms, perms_b)
+
+
 def test_randomize_classifier():
     """Test basic functions of randomize_classifier."""
     data = dict(X=spstats.norm(0, 1).rvs((100, 12)),
@@ -410,6 +665,111 @@ def test_randomize_classifier_seed():
     assert_array_equal(out_a, out_b)
 
 
+def test_randomize_classifier_backends():
+    """Test that parallel backends give the same null distribution."""
+    data = datasets_3d[0]
+    model = GaussianNB()
+
+    class SerialExecutor(object):
+        """Minimal map-like executor."""
+        def __init__(self):
+            self.n_tasks = 0
+
+        def map(self, func, tasks):
+            tasks = list(tasks)
+            self.n_tasks = len(tasks)
+            return [func(task) for task in tasks]
+
+    p_a, dist_a = stat.randomize_classifier(data, model, 20, random_seed=0,
+                                            return_dist=True)
+    for backend in ["thread", "process"]:
+        p_b, dist_b = stat.randomize_classifier(data, model, 20,
+                                                random_seed=0,
+                                                return_dist=True,
+                                                n_jobs=2, backend=backend)
+        assert_array_equal(p_a, p_b)
+        assert_array_equal(dist_a, dist_b)
+
+    executor = SerialExecutor()
+    p_b, dist_b = stat.randomize_classifier(data, model, 20, random_seed=0,
+                                            return_dist=True, n_jobs=3,
+                                            backend=executor)
+    assert_array_equal(dist_a, dist_b)
+    assert_equal(executor.n_tasks, 3)
+
+
+def test_randomize_classifier_executor_workers():
+    """Test that an executor gets a batch of permutations per worker."""
+    try:
+        from concurrent.futures import ThreadPoolExecutor
+    except ImportError:
+        raise nose.SkipTest("concurrent.futures is not available")
+
+    class CountingExecutor(ThreadPoolExecutor):
+        """Thread pool that counts the tasks submitted to it."""
+        n_tasks = 0
+
+        def submit(self, *args, **kwargs):
+            self.n_tasks += 1
+            return super(CountingExecutor, self).submit(*args, **kwargs)
+
+    data = datasets_3d[0]
+    model = GaussianNB()
+    dist_a = stat.randomize_classifier(data, model, 20, random_seed=0,
+                                       return_dist=True)[1]
+    executor = CountingExecutor(max_workers=2)
+    try:
+        dist_b = stat.randomize_classifier(data, model, 20, random_seed=0,
+                                           return_dist=True,
+                                           backend=executor)[1]
+    finally:
+        executor.shutdown()
+    assert_array_equal(dist_a, dist_b)
+    assert_equal(executor.n_tasks, 2)
+
+
+def test_randomize_classifier_memmap():
+    """Test decoding from memory-mapped features."""
+    data = datasets_3d[1]
+    model = GaussianNB()
+    p_a, dist_a = stat.randomize_classifier(data, model, 20, random_seed=0,
+                                            return_dist=True)
+    for n_jobs in [1, 2]:
+        p_b, dist_b = stat.randomize_classifier(data, model, 20,
+                                                random_seed=0,
+                                                return_dist=True,
+                                                n_jobs=n_jobs, memmap=True)
+        assert_array_equal(p_a, p_b)
+        assert_array_equal(dist_a, dist_b)
+
+
+def test_randomize_classifier_ridge():
+    """Test the batched ridge null against refitting each permutation."""
+    rs = np.random.RandomState(0)
+    X = rs.randn(2, 36, 8)
+    y = rs.randint(0, 3, 36)
+    runs = np.repeat([0, 1, 2], 12)
+    perms = [rs.permutation(36) for i in range(10)]
+    for cv in [stat.LeaveOneLabelOut(runs), stat.LeaveOneOut(36)]:
+        for fit_intercept in [True, False]:
+            model = RidgeClassifier(alpha=2, fit_intercept=fit_intercept)
+            dist = stat._ridge_null(model, X, y, cv, perms)
+            for i, perm in enumerate(perms):
+                for j, X_j in enumerate(X):
+                    acc = stat.cross_val_score(model, X_j, y[perm], cv=cv)
+                    assert_almost_equal(dist[i, j], acc.mean())
+
+    # Models and settings without a batched path are refit on each
+    # permutation
+    assert stat._ridge_null(GaussianNB(), X, y, cv, perms) is None
+    model = RidgeClassifier(class_weight="balanced")
+    assert stat._ridge_null(model, X, y, cv, perms) is None
+    model = RidgeClassifier()
+    if "positive" in model.get_params():
+        model.set_params(positive=True)
+        assert stat._ridge_null(model, X, y, cv, perms) is None
+
+
 def test_randomize_classifier_number():
     """Test size of randomize_classifier vectors."""
     data = datasets[0]
@@ -440,6 +800,32 @@ def test_transition_probabilities():
     npt.assert_equal(out.columns, out.index)
 
 
+def test_transition_matrix():
+    """Test the array-based transition probabilities."""
+    sched = [0, 0, 1, 1]
+    assert_array_equal(stat.transition_matrix(sched), [[.5, .5], [0, 1]])
+
+    # Types that never precede a trial get undefined probabilities
+    probs = stat.transition_matrix([0, 1, 2], 4)
+    assert_equal(probs.shape, (4, 4))
+    assert np.isnan(probs[2:]).all()
+
+    scheds = np.random.randint(0, 3, (20, 50))
+    probs = stat.transition_matrix(scheds, 3)
+    assert_equal(probs.shape, (20, 3, 3))
+    for sched, probs_i in zip(scheds, probs):
+        assert_array_equal(stat.transition_matrix(sched, 3), probs_i)
+        expected = stat.transition_probabilities(sched)
+        assert_array_almost_equal(expected.values, probs_i)
+
+
+def test_transition_matrix_code_error():
+    """Test that codes outside the trial types raise ValueError."""
+    for sched in [[0, 1, 3], [0, -1, 1]]:
+        nose.tools.assert_raises(ValueError, stat.transition_matrix,
+                                 sched, 3)
+
+
 def test_gamma_hrf_fit_direct():
     """Very basic test of HRF fitting."""
     hrf = stat.GammaHRF()
@@ -494,3 +880,80 @@ def test_gamma_hrf_bounds():
     hrf.fit(x, y)
     nose.tools.assert_less(hrf.shape_, 5.75)
     nose.tools.assert_less_equal(1, hrf.scale_)
+
+
+def test_gamma_hrf_jacobian():
+    """Test the analytic HRF derivatives against finite differences."""
+    x = np.linspace(0, 20, 41)
+    vals = np.array([6., -.5, .9, 2., .1])
+
+    def model(vals):
+        shape, loc, scale, coef, baseline = vals
+        return coef * stat._gamma_pdf(x, shape, loc, scale) + baseline
+
+    pdf, jac = stat._gamma_hrf_jacobian(x, *vals[:4])
+    npt.assert_allclose(pdf, spstats.gamma(6, -.5, .9).pdf(x))
+    for i in range(5):
+        step = np.zeros(5)
+        step[i] = 1e-6
+        deriv = (model(vals + step) - model(vals - step)) / 2e-6
+        npt.assert_allclose(jac[:, i], deriv, atol=1e-6)
+
+
+def test_gamma_hrf_fit_many():
+    """Test fitting many timecourses at once."""
+    x = np.arange(24)
+    shapes = np.array([5, 6, 7])
+    scales = np.array([.8, .9, 1])
+    Y = spstats.gamma(shapes, 0, scales).pdf(x[:, np.newaxis]) * [1, 2, 3]
+    hrf = stat.GammaHRF(loc=0, bounds=dict(loc=(0, 0))).fit_many(x, Y)
+    npt.assert_allclose(hrf.shape_, shapes, atol=1e-4)
+    npt.assert_allclose(hrf.scale_, scales, atol=1e-4)
+    npt.assert_allclose(hrf.coef_, [1, 2, 3], atol=1e-4)
+    npt.assert_allclose(hrf.baseline_, 0, atol=1e-6)
+    npt.assert_allclose(hrf.fit_r2_, 1)
+    npt.assert_allclose(hrf.predict(x), Y, atol=1e-6)
+    npt.assert_allclose(hrf.peak_time_, (shapes - 1) * scales, atol=1e-3)
+
+    # Fits should be as good as those to each timecourse on its own
+    Y += np.random.RandomState(0).normal(0, .01, Y.shape)
+    hrf = stat.GammaHRF().fit_many(x, Y)
+    assert_equal(hrf.fit_r2_.shape, (3,))
+    for i, y in enumerate(Y.T):
+        single = stat.GammaHRF().fit(x, y)
+        ss_single = np.square(y - single.predict(x)).sum()
+        ss_many = np.square(y - hrf.predict(x)[:, i]).sum()
+        nose.tools.assert_less(ss_many, ss_single * 1.01)
+
+
+def test_gamma_hrf_fit_many_noisy():
+    """Test that fits to noisy timecourses are about as good as single fits.
+
+    Both fits can end in different local minima on noisy data, so this
+    checks the sums of squares overall and for most timecourses.
+
+    """
+    rs = np.random.RandomState(0)
+    x = np.arange(24)
+    n = 50
+    shapes = rs.uniform(5, 8, n)
+    scales = rs.uniform(.8, 1.1, n)
+    coefs = rs.uniform(1, 3, n)
+    Y = spstats.gamma(shapes, 0, scales).pdf(x[:, np.newaxis]) * coefs
+    Y += rs.normal(0, .1, Y.shape)
+
+    hrf = stat.GammaHRF().fit_many(x, Y)
+    ss_many = np.square(Y - hrf.predict(x)).sum(axis=0)
+    ss_single = np.empty(n)
+    for i, y in enumerate(Y.T):
+        single = stat.GammaHRF().fit(x, y)
+        ss_single[i] = np.square(y - single.predict(x)).sum()
+    ratio = ss_many / ss_single
+    nose.tools.assert_less(ss_many.sum(), ss_single.sum() * 1.01)
+    nose.tools.assert_less(np.mean(ratio > 1.02), .1)
+    nose.tools.assert_less(ratio.max(), 1.5)
+
+    # Checking fits against single fits can only improve them
+    hrf = stat.GammaHRF().fit_many(x, Y, check_fits=True)
+    ss_checked = np.square(Y - hrf.predict(x)).sum(axis=0)
+    npt.assert_array_less(ss_checked, ss_many * (1 + 1e-10))